@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .builder import get_client
+
+logger_epo = logging.getLogger('EPO')
+
+# how many OPS calls can be in flight at the same time
+DEFAULT_MAX_WORKERS = 20
+
+
+class AsyncEspacenetBuilderClient(object):
+    """
+    asyncio counterpart of EspacenetBuilderClient
+    Calls are run in a pool of threads through a shared EspacenetBuilderClient,
+    with the same parsing, and every call returns its own result,
+    so they can be awaited concurrently
+    The shared client is the one of get_client(), to give it as many connections
+    as workers, call set_client_defaults(pool_size=max_workers) before it is built
+    """
+    def __init__(self, client=None, max_workers=DEFAULT_MAX_WORKERS):
+        self.client = client or get_client()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def apatent(self, *args, **kwargs):
+        r"""
+        Retrieve a specific patent
+        :Keyword Arguments:
+            * *input* (``epo_ops.models``) --
+        """
+        _, patent = await self._run(self.client._fetch_patent, *args, **kwargs)
+        return patent
+
+    async def afamily(self, *args, **kwargs):
+        r"""
+        Retrieve the family of a patent, with the biblio of its best patent
+        :Keyword Arguments:
+            * *input* (``epo_ops.models``) --
+        """
+        _, family = await self._run(self.client._fetch_family, *args, **kwargs)
+        return family
+
+    async def asearch(self, value, range_begin=None, range_end=None, id_only=False):
+        """ Entry method that decide if auto_range is needed, see EspacenetBuilderClient.search """
+        if range_begin and range_end:
+            return await self._run(self.client._fetch_search_in_range,
+                                   cql = value,
+                                   range_begin = range_begin,
+                                   range_end = range_end,
+                                   id_only = id_only)
+        else:
+            return await self._run(self.client.published_data_search, cql = value, id_only = id_only)
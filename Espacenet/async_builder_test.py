@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import epo_ops
+
+from .async_builder import AsyncEspacenetBuilderClient
+from .builder import get_client, reset_clients
+from .testing import TemporaryDataDirTestCase
+
+
+class SlowFakeClient(object):
+    """ answer after a delay with the asked input, and count simultaneous calls """
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def _fetch_patent(self, input):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        return {}, input.number
+
+
+class TestAsyncEspacenetBuilderClient(TemporaryDataDirTestCase):
+    def test_should_overlap_calls_and_keep_results_apart(self):
+        fake_client = SlowFakeClient()
+        client = AsyncEspacenetBuilderClient(client=fake_client, max_workers=10)
+        numbers = ['EP%s' % i for i in range(10)]
+
+        async def fetch_all():
+            return await asyncio.gather(*[
+                client.apatent(input=epo_ops.models.Epodoc(number)) for number in numbers
+            ])
+
+        try:
+            results = asyncio.run(fetch_all())
+        finally:
+            client.close()
+
+        self.assertEqual(results, numbers)
+        self.assertGreater(fake_client.max_in_flight, 1)
+
+    def test_should_use_the_shared_client(self):
+        client = AsyncEspacenetBuilderClient(max_workers=2)
+        try:
+            self.assertIs(client.client, get_client())
+        finally:
+            client.close()
+            reset_clients()
+
+
+class TestAsyncEspacenetBuilder(unittest.TestCase):
+    def test_should_fetch_patent_and_family(self):
+        client = AsyncEspacenetBuilderClient()
+
+        async def fetch_both():
+            return await asyncio.gather(
+                client.apatent(input = epo_ops.models.Docdb('1000000', 'EP', 'A1')),
+                client.afamily(input = epo_ops.models.Epodoc('EP1000000')),
+            )
+
+        try:
+            patent, (patents_families, fulfilled_patent) = asyncio.run(fetch_both())
+        finally:
+            client.close()
+
+        self.assertEqual(patent.epodoc, 'EP1000000')
+        self.assertIn('19768124', patents_families.keys())
+        self.assertEqual(fulfilled_patent.epodoc, 'EP1000000')
@@ -1,22 +1,167 @@
 # -*- coding: utf-8 -*-
 
 import logging, json
+import re
+import threading
+import collections
+import calendar
+import datetime
+import contextlib
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 
 import epo_ops
+import requests
 
 from .patent_models import PatentFamilies
 from .marc import MarcEspacenetPatent as EspacenetPatent
 from .epo_secrets import get_secret
+from .session import PooledRequest, build_session, DEFAULT_POOL_SIZE
+from .throttle import get_scheduler, DEFAULT_MAX_CONCURRENCY
+from .quota import QuotaAccounting
+from .retry import RetryPolicy
+from .singleflight import SingleFlight
+from .negative_cache import NegativeCache
+from .cache import ResponseCache, publication_key, PUBLICATION_URL_REGEX
+from .memory_cache import MemoryCache, DEFAULT_MEMORY_CACHE_BYTES
+from .token_store import TokenStore, StoredAccessToken
 from .utils import p_json, _get_best_patent_for_data
 
 logger_epo = logging.getLogger('EPO')
 
+# OPS accepts up to 100 numbers in one biblio retrieval
+BULK_SIZE_LIMIT = 100
+
+# OPS gives up to 100 results by search page, and no result after the 10000th
+SEARCH_RANGE_SIZE = 100
+SEARCH_RESULTS_LIMIT = 10000
+
+# a search with too many results is split by publication dates from this year, what is before is one slice
+SEARCH_SPLIT_FIRST_YEAR = 1900
+
+# how many search pages are fetched at the same time, the throttle of the search service has the last word
+SEARCH_MAX_WORKERS = DEFAULT_MAX_CONCURRENCY
+
+# renew the access token this number of seconds before it expires
+TOKEN_REFRESH_MARGIN = 60
+
+# clients shared by the whole process, by settings
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+# settings of the shared clients, when not given, see set_client_defaults
+_client_defaults = {'use_cache': True, 'use_network': True}
+
+
+def get_client(**kwargs):
+    """
+    Get the client shared by the whole process for these settings,
+    so the http session and the OAuth token are paid only once per run
+    Takes the same keyword arguments as EspacenetBuilderClient
+    """
+    with _shared_clients_lock:
+        for name, value in _client_defaults.items():
+            kwargs.setdefault(name, value)
+        key = tuple(sorted(kwargs.items()))
+
+        if key not in _shared_clients:
+            logger_epo.debug("Building a new shared client with %s" % kwargs)
+            _shared_clients[key] = EspacenetBuilderClient(**kwargs)
+        return _shared_clients[key]
+
+
+def set_client_defaults(**kwargs):
+    """
+    Change the settings of the shared clients for the rest of the run,
+    like set_client_defaults(use_network=False) for a run served only from the cache
+    """
+    with _shared_clients_lock:
+        _client_defaults.update(kwargs)
+
+
+def reset_clients():
+    """ Forget the shared clients, next get_client() will build new ones """
+    with _shared_clients_lock:
+        for client in _shared_clients.values():
+            client.close()
+        _shared_clients.clear()
+
+def _input_key(input, endpoint='patent'):
+    """
+    what identify an epo_ops.models input in a request, as a normalized text,
+    the same for the Epodoc and the Docdb of a publication when we can, see cache.publication_key
+    """
+    input_format = input.__class__.__name__.lower()
+    return publication_key(input_format, input.as_api_input(), with_kind=endpoint != 'family') or \
+        "%s:%s" % (input_format, input.as_api_input().upper().replace(' ', ''))
+
+
+def _family_fingerprint(content):
+    """
+    what changes in a family response when the family changes :
+    the docdb and the date of its members, None if there is no family in it
+    """
+    try:
+        members = json.loads(content)['ops:world-patent-data']['ops:patent-family']['ops:family-member']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    if not isinstance(members, (tuple, list)):
+        members = [members]
+
+    fingerprint = set()
+    for member in members:
+        document_ids = member.get('publication-reference', {}).get('document-id', [])
+        if not isinstance(document_ids, (tuple, list)):
+            document_ids = [document_ids]
+
+        for document in document_ids:
+            if document.get('@document-id-type') == 'docdb':
+                fingerprint.add(tuple(document.get(field, {}).get('$')
+                                      for field in ('country', 'doc-number', 'kind', 'date')))
+
+    return frozenset(fingerprint)
+
+
+def _search_ranges(total_count, range_begin=1):
+    """ the (begin, end) of the search pages needed to get total_count results, from range_begin """
+    range_last = min(total_count, SEARCH_RESULTS_LIMIT)
+    return [(begin, min(begin + SEARCH_RANGE_SIZE - 1, range_last))
+            for begin in range(range_begin, range_last + 1, SEARCH_RANGE_SIZE)]
+
+
+def _months_cql(cql, first_month, last_month):
+    """
+    the cql query, limited to publications between these months, as year * 12 + month - 1,
+    or to all the ones up to last_month when first_month is None
+    """
+    if first_month is None:
+        before_year, before_month = divmod(last_month + 1, 12)
+        return '(%s) and pd<%04d%02d01' % (cql, before_year, before_month + 1)
+
+    first_year, first_month = divmod(first_month, 12)
+    last_year, last_month = divmod(last_month, 12)
+    last_day = calendar.monthrange(last_year, last_month + 1)[1]
+    return '(%s) and pd within "%04d%02d01 %04d%02d%02d"' % (
+        cql, first_year, first_month + 1, last_year, last_month + 1, last_day)
+
+
+def _split_months(first_month, last_month):
+    """ halves of this period, at a new year when it is more than one year, as (first_month, last_month) """
+    first_year, last_year = first_month // 12, last_month // 12
+    if first_year != last_year:
+        middle = (first_year + (last_year - first_year + 1) // 2) * 12
+    else:
+        middle = first_month + (last_month - first_month + 1) // 2
+    return [(first_month, middle - 1), (middle, last_month)]
+
+
 def fetch_abstract_from_all_patents(patents):
     """
     As abstract may not be fulfilled, try to fetch some patents until we get one
     """
     patent_country_with_potential_abstract = ['EP', 'US', 'WO']
-    client = EspacenetBuilderClient(use_cache=True)
+    client = get_client()
 
     for patent in patents:
         if patent.epodoc and patent.epodoc[0:2] in patent_country_with_potential_abstract:
@@ -32,9 +177,9 @@ def fetch_abstract_from_all_patents(patents):
 
 
 class EspacenetSearchResult:
-    patent_families = PatentFamilies()
-
     def __init__(self, json_fetched=None):
+        self.patent_families = PatentFamilies()
+
         if json_fetched:
             biblio_search = json_fetched['ops:biblio-search']
 
@@ -47,30 +192,262 @@ class EspacenetSearchResult:
             self.total_count = None
 
 
+# what a search will give and cost, see EspacenetBuilderClient.count,
+# request_count is only a lower bound past the 10'000 results
+SearchCount = collections.namedtuple('SearchCount', ['total_count', 'page_count', 'request_count'])
+
+
 class EspacenetBuilderClient(epo_ops.Client):
     """Build models from returned json, based on the epo_ops.Client
        Force Json format as return
+    All the calls go through one keep-alive session of pool_size connections
+    The access token is saved on disk and renewed in background before it expires
+    Calls are throttled service by service, see throttle.ThrottleScheduler
+    What the calls cost is counted in self.quota, see quota.QuotaAccounting
+    Transient errors are retried, see retry.RetryPolicy
+    Identical calls running at the same time share one request and its result
+    With the cache, responses are kept on disk for two weeks, see cache.ResponseCache,
+    the parsed patents and families of the run are kept in memory, up to memory_cache_bytes,
+    and inputs refused by OPS are remembered, see negative_cache.NegativeCache
+    Without use_network, everything comes from the cache, and OPS is never called,
+    not even for a token
     """
-    def __init__(self, use_cache=True, *args, **kwargs):
+    def __init__(self, use_cache=True, pool_size=DEFAULT_POOL_SIZE,
+                 memory_cache_bytes=DEFAULT_MEMORY_CACHE_BYTES, use_network=True, *args, **kwargs):
+        if not use_network and not use_cache:
+            raise ValueError("Without the network, the cache is needed")
+        self.use_network = use_network
+
         if not "key" in kwargs and not "secret" in kwargs:
-            kwargs['key'] = get_secret()["client_id"]
-            kwargs['secret'] = get_secret()["client_secret"]
+            if use_network:
+                kwargs['key'] = get_secret()["client_id"]
+                kwargs['secret'] = get_secret()["client_secret"]
+            else:
+                kwargs['key'] = kwargs['secret'] = None
 
         kwargs['accept_type'] = 'json'
+        self.quota = QuotaAccounting()
         kwargs['middlewares'] = [
-            epo_ops.middlewares.Throttler(),
+            get_scheduler(),
+            self.quota,
         ]
 
         if use_cache:
             logger_epo.debug("Cache middleware is enabled")
-            kwargs['middlewares'].insert(0, epo_ops.middlewares.Dogpile())
+            self.cache = ResponseCache()
+            if use_network:
+                self.cache.revalidate_with = self._revalidate
+            else:
+                logger_epo.debug("Network is disabled, serving only from the cache")
+                self.cache.offline = True
+            kwargs['middlewares'].insert(0, self.cache)
+            self.memory_cache = MemoryCache(memory_cache_bytes)
+            self.negative_cache = NegativeCache()
         else:
             logger_epo.debug("Cache middleware is disabled")
+            self.cache = None
+            self.memory_cache = None
+            self.negative_cache = None
 
         super().__init__(*args, **kwargs)
 
-        # save raw returned json
-        json_parsed = ""
+        self.session = build_session(pool_size)
+        self.request = PooledRequest(self.middlewares, self.session)
+
+        self.retry_policy = RetryPolicy()
+        self.single_flight = SingleFlight()
+
+        self._token_lock = threading.RLock()
+        self._token_refresh_timer = None
+        self.token_store = TokenStore(self.key) if use_network else None
+        self._access_token = self.token_store.load() if use_network else None
+        if self._access_token:
+            self._schedule_token_refresh()
+
+        # save raw returned json, by thread
+        self._local = threading.local()
+
+    @property
+    def json_parsed(self):
+        """ the last json returned to this thread """
+        return getattr(self._local, 'json_parsed', "")
+
+    @json_parsed.setter
+    def json_parsed(self, value):
+        self._local.json_parsed = value
+
+    def close(self):
+        """ stop the background token refresh and cache refresh, and close the connections """
+        with self._token_lock:
+            if self._token_refresh_timer:
+                self._token_refresh_timer.cancel()
+                self._token_refresh_timer = None
+        if self.cache:
+            self.cache.close()
+        self.session.close()
+
+    def log_summary(self):
+        """ log what the run has cost and what the caches gave, keep the cache stats for the next runs """
+        logger_epo.info(self.quota.summary())
+        if self.cache:
+            logger_epo.info(self.cache.summary())
+            self.cache.save_stats()
+        if self.memory_cache:
+            logger_epo.info(self.memory_cache.summary())
+        if self.negative_cache and self.negative_cache.hits:
+            logger_epo.info(self.negative_cache.report())
+
+    @property
+    def access_token(self):
+        with self._token_lock:
+            if not self._access_token or self._access_token.expires_in <= TOKEN_REFRESH_MARGIN:
+                self._acquire_token()
+            return self._access_token
+
+    def _schedule_token_refresh(self):
+        """ renew the token in background a bit before it expires """
+        with self._token_lock:
+            if self._token_refresh_timer:
+                self._token_refresh_timer.cancel()
+
+            delay = max(self._access_token.expires_in - TOKEN_REFRESH_MARGIN, 0)
+            self._token_refresh_timer = threading.Timer(delay, self._refresh_token)
+            self._token_refresh_timer.daemon = True
+            self._token_refresh_timer.start()
+
+    def _refresh_token(self):
+        try:
+            with self._token_lock:
+                self._acquire_token()
+        except requests.exceptions.RequestException as e:
+            # not fatal, the next call will try again
+            logger_epo.warning("Unable to renew the access token in background: %s" % e)
+
+    def _check_for_expired_token(self, response):
+        """ on a refused token, get a new one and replay the request once """
+        if response.status_code not in (requests.codes.bad, requests.codes.unauthorized):
+            return response
+
+        content = response.content.decode('utf-8', 'replace').lower()
+        if 'access token' not in content and 'access_token' not in content:
+            return response
+
+        logger_epo.debug("The access token has been refused, renewing it")
+        with self._token_lock:
+            self._acquire_token()
+
+        headers = dict(response.request.headers)
+        headers['Authorization'] = 'Bearer {0}'.format(self._access_token.token)
+        return self.request.post(
+            response.request.url, data=response.request.body, headers=headers
+        )
+
+    def _make_request(self, url, data, extra_headers=None, params=None):
+        if not self.use_network:
+            # no token, no retry, the cache has it or a NotInCacheError is raised
+            response = self._post(url, data, extra_headers, params)
+            response.raise_for_status()
+            return response
+
+        return self.retry_policy.call(super()._make_request, url, data, extra_headers, params)
+
+    def _revalidate(self, url, data, headers=None, params=None):
+        """ do again a call the cache has served stale, for the cache to get a fresh one """
+        if self.quota.budget_exceeded:
+            logger_epo.debug("Not refreshing %s, the OPS budget of the run is spent" % url)
+            return
+
+        extra_headers = {k: v for k, v in (headers or {}).items() if k != 'Authorization'}
+
+        matched = re.match(PUBLICATION_URL_REGEX, url)
+        if matched and matched.group('service') == 'family' and matched.group('rest') == '/biblio' and \
+                self._is_family_unchanged(url, data, extra_headers, params):
+            return
+
+        self._make_request(url, data, dict(extra_headers), params)
+
+    def _is_family_unchanged(self, url, data, extra_headers, params):
+        """
+        compare the members of a stale family with the ones of the compact family
+        listing, and if nothing moved, keep the family and the biblio of its members
+        """
+        key = self.cache.generate_key(url, data)
+        stale = self.cache.backend.get(key, max_stale=self.cache.max_stale)
+        if not stale or stale.status != requests.codes.ok:
+            return False
+
+        stale_fingerprint = _family_fingerprint(stale.body)
+        if not stale_fingerprint:
+            return False
+
+        # the same call, without the biblio of every member
+        listing = self._make_request(url[:-len('/biblio')], data, dict(extra_headers), params)
+        if _family_fingerprint(listing.content) != stale_fingerprint:
+            return False
+
+        keys = [key]
+        for country, number, kind, _ in stale_fingerprint:
+            member = epo_ops.models.Docdb(number, country, kind)
+            member_url = self._make_request_url(self.__published_data_path__, 'publication', member, 'biblio', [])
+            keys.append(self.cache.generate_key(member_url, member.as_api_input()))
+        self.cache.touch(keys)
+
+        logger_epo.debug("Family of %s is unchanged, keeping it and its %s members" % (data, len(keys) - 1))
+        return True
+
+    def _acquire_token(self):
+        """ same as epo_ops, but through our session, and saved for the next runs """
+        headers = {
+            'Authorization': 'Basic {0}'.format(
+                b64encode(
+                    '{0}:{1}'.format(self.key, self.secret).encode('ascii')
+                ).decode('ascii')
+            ),
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+        payload = {'grant_type': 'client_credentials'}
+        response = self.session.post(
+            self.__auth_url__, headers=headers, data=payload
+        )
+        response.raise_for_status()
+        self._access_token = StoredAccessToken.from_response(response)
+        self.token_store.save(self._access_token)
+        logger_epo.debug("A new access token has been acquired")
+        self._schedule_token_refresh()
+
+    def _fetch(self, endpoint, func, *args, **kwargs):
+        """ get a parsed result from memory, or through all the OPS machinery """
+        key = (endpoint, _input_key(kwargs['input'], endpoint))
+
+        if not self.memory_cache:
+            return self.single_flight.do(key, self._remember_bad_input, endpoint, func, *args, **kwargs)
+
+        return self.memory_cache.get_or_call(
+            key,
+            self.single_flight.do, key, self._remember_bad_input, endpoint, func, *args, **kwargs)
+
+    def _remember_bad_input(self, endpoint, func, *args, **kwargs):
+        """ go through the negative cache, if we have one """
+        if not self.negative_cache:
+            return func(*args, **kwargs)
+
+        return self.negative_cache.remember(endpoint, _input_key(kwargs['input'], endpoint),
+                                            func, *args, **kwargs)
+
+    def _load_json(self, request):
+        """ parse the returned content and get the data wrapper """
+        try:
+            json_parsed = json.loads(request.content)
+        except ValueError as e:
+            raise ValueError("Value error for : %s" % request.content) from e
+
+        try:
+            json_parsed['ops:world-patent-data']
+        except KeyError:
+            # this should not happens
+            raise
+
+        return json_parsed
 
     def _parse_exchange_document(self, exchange_document):
         """ from an exchange_document, verify it's valid and sent it to patent builder """
@@ -85,12 +462,11 @@ class EspacenetBuilderClient(epo_ops.Client):
             exchange_document = exchange_document[0]
         return self._parse_exchange_document(exchange_document)
 
-    def patent(self, *args, **kwargs):
-        r"""
-        Retrieve a specific patent
-        :Keyword Arguments:
-            * *input* (``epo_ops.models``) --
-        """
+    def _fetch_patent(self, *args, **kwargs):
+        """ fetch and parse a patent, return the raw json with it """
+        return self._fetch('patent', self._request_patent, *args, **kwargs)
+
+    def _request_patent(self, *args, **kwargs):
         logger_epo.debug("Patent fetching API with patent %s ..." % kwargs['input'].as_api_input())
 
         # only published patents
@@ -100,30 +476,155 @@ class EspacenetBuilderClient(epo_ops.Client):
         kwargs['constituents'] = []
 
         request = super().published_data(*args, **kwargs)
-        json_fetched = request.content
+        json_parsed = self._load_json(request)
 
-        try:
-            self.json_parsed = json.loads(json_fetched)
-        except ValueError as e:
-            raise ValueError("Value error for : %s" % request.content) from e
-
-        try:
-            json_parsed = self.json_parsed['ops:world-patent-data']
-        except KeyError:
-            # this should not happens
-            raise
-
-        if not json_parsed:
-            return PatentFamilies()
+        if not json_parsed['ops:world-patent-data']:
+            return json_parsed, PatentFamilies()
 
         logger_epo.debug("Parsing a returned json...")
 
-        patent = self._parse_patent(json_parsed)
+        patent = self._parse_patent(json_parsed['ops:world-patent-data'])
 
         logger_epo.debug("Patent found and returning")
 
+        return json_parsed, patent
+
+    def patent(self, *args, **kwargs):
+        r"""
+        Retrieve a specific patent
+        :Keyword Arguments:
+            * *input* (``epo_ops.models``) --
+        """
+        self.json_parsed, patent = self._fetch_patent(*args, **kwargs)
         return patent
 
+    def _input_matches(self, input, exchange_document):
+        """ is this exchange_document the answer for this input """
+        country = exchange_document.get('@country', '')
+        number = exchange_document.get('@doc-number', '')
+        kind = exchange_document.get('@kind', '')
+
+        if isinstance(input, epo_ops.models.Docdb):
+            return (input.country_code, input.number, input.kind_code) == (country, number, kind)
+        else:
+            epodoc = input.number.replace(' ', '').upper()
+            return epodoc == country + number and (not input.kind_code or input.kind_code == kind)
+
+    def _fetch_patents_bulk(self, inputs):
+        """ one request for all these inputs, they have to be of the same type """
+        logger_epo.debug("Patent bulk fetching API with %s patents ..." % len(inputs))
+
+        url = self._make_request_url(
+            self.__published_data_path__, 'publication', inputs[0], 'biblio', []
+        )
+        request = self._make_request(url, '\n'.join([x.as_api_input() for x in inputs]))
+        json_parsed = self._load_json(request)['ops:world-patent-data']
+
+        # we can have a list of exchange-documents or a list of exchange-document
+        exchange_documents = json_parsed.get('exchange-documents', [])
+        if not isinstance(exchange_documents, (tuple, list)):
+            exchange_documents = [exchange_documents]
+
+        documents = []
+        for exchange_documents_json in exchange_documents:
+            exchange_document = exchange_documents_json['exchange-document']
+            if not isinstance(exchange_document, (tuple, list)):
+                exchange_document = [exchange_document]
+            documents.extend(exchange_document)
+
+        patents = collections.OrderedDict()
+
+        for input in inputs:
+            matching = [exchange_document for exchange_document in documents
+                        if exchange_document.get('@status') != 'not found' and
+                        self._input_matches(input, exchange_document)]
+            if not matching:
+                continue
+
+            # as in _parse_patent, keep only the first when we have multiple kinds
+            patents[input] = self._parse_exchange_document(matching[0])
+
+            if self.cache and not getattr(request, 'from_cache', False):
+                self._store_bulk_document(url, input, request, matching)
+
+        return patents
+
+    def _store_bulk_document(self, url, input, request, exchange_documents):
+        """
+        keep the part of a bulk response about this input in the cache,
+        as the response of its own biblio call, so patent() will not ask OPS for it
+        """
+        content = {'ops:world-patent-data': {'exchange-documents': {
+            'exchange-document': exchange_documents[0] if len(exchange_documents) == 1 else exchange_documents,
+        }}}
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in ('content-length', 'content-encoding')}
+        self.cache.store(url, input.as_api_input(), request.status_code, request.reason, headers,
+                         json.dumps(content).encode('utf-8'))
+
+    def _cached_patent(self, input):
+        """
+        the patent of this input from the cache of its own biblio call, as kept by patent() or
+        by a previous bulk, None if it is not cached, False if OPS has not found it
+        """
+        if not self.cache:
+            return None
+
+        url = self._make_request_url(self.__published_data_path__, 'publication', input, 'biblio', [])
+        response = self.cache.lookup(url, input.as_api_input())
+        if response is None:
+            return None
+
+        if response.status_code != requests.codes.ok:
+            return False
+        json_parsed = self._load_json(response)['ops:world-patent-data']
+        if not json_parsed:
+            return False
+        return self._parse_patent(json_parsed)
+
+    def patents_bulk(self, inputs):
+        r"""
+        Retrieve many patents, with one request by batch of BULK_SIZE_LIMIT
+        The ones in the cache are served from it, only the others are asked,
+        and left out when offline
+        :Arguments:
+            * *inputs* (list of ``epo_ops.models.Epodoc`` or ``epo_ops.models.Docdb``) --
+        Return an ordered dict of input -> patent,
+        inputs unknown to Espacenet are not in it
+        """
+        inputs = list(inputs)
+        patents = {}
+
+        # the input type is in the url, so one batch has only one type
+        inputs_by_type = collections.OrderedDict()
+        for input in inputs:
+            if self.negative_cache and self.negative_cache.get('patent', _input_key(input)):
+                # no need to ask, OPS already said no
+                continue
+
+            cached = self._cached_patent(input)
+            if cached is not None:
+                if cached:
+                    patents[input] = cached
+                continue
+
+            if not self.use_network:
+                # what the cache has is still worth it
+                self.cache.record_offline_miss(self._make_request_url(
+                    self.__published_data_path__, 'publication', input, 'biblio', []), input.as_api_input())
+                continue
+
+            inputs_by_type.setdefault(input.__class__, []).append(input)
+
+        for typed_inputs in inputs_by_type.values():
+            for i in range(0, len(typed_inputs), BULK_SIZE_LIMIT):
+                patents.update(self._fetch_patents_bulk(typed_inputs[i:i + BULK_SIZE_LIMIT]))
+
+        logger_epo.debug("Bulk fetch found %s patents for %s inputs, %s were asked to OPS" % (
+            len(patents), len(inputs), sum(len(typed_inputs) for typed_inputs in inputs_by_type.values())))
+
+        # in the order of the inputs
+        return collections.OrderedDict((input, patents[input]) for input in inputs if input in patents)
+
     def _parse_families_members(self, family_member):
         """
         Set all patent to his family ID (as dict key)
@@ -145,12 +646,11 @@ class EspacenetBuilderClient(epo_ops.Client):
 
         return families_patents
 
-    def family(self, *args, **kwargs):
-        r"""
-        Do a search inside a specific range
-        :Keyword Arguments:
-            * *input* (``epo_ops.models``) --
-        """
+    def _fetch_family(self, *args, **kwargs):
+        """ fetch and parse a family, return the raw json with it """
+        return self._fetch('family', self._request_family, *args, **kwargs)
+
+    def _request_family(self, *args, **kwargs):
         logger_epo.debug("Family fetching API with patent %s ..." % kwargs['input'].as_api_input())
 
         # only published patents
@@ -160,21 +660,11 @@ class EspacenetBuilderClient(epo_ops.Client):
         kwargs['constituents'] = []
 
         request = super().family(*args, **kwargs)
-        json_fetched = request.content
-
-        try:
-            self.json_parsed = json.loads(json_fetched)
-        except ValueError as e:
-            raise ValueError("Value error for : %s" % request.content) from e
-
-        try:
-            json_parsed = self.json_parsed['ops:world-patent-data']
-        except KeyError:
-            # this should not happens
-            raise
+        json_fetched = self._load_json(request)
+        json_parsed = json_fetched['ops:world-patent-data']
 
         if not json_parsed:
-            return PatentFamilies()
+            return json_fetched, PatentFamilies()
 
         family_member = json_parsed['ops:patent-family']['ops:family-member']
 
@@ -186,8 +676,6 @@ class EspacenetBuilderClient(epo_ops.Client):
 
         best_patent_to_fetch = _get_best_patent_for_data(family_patents_list.patents)
 
-        client = EspacenetBuilderClient(use_cache=True)
-
         #MAYBE: fullfil all patent in the family (in bulk), as some have the abstract and some don't
         # Proto :
         # if not "abstract" in "%s" % json_parsed:
@@ -198,33 +686,43 @@ class EspacenetBuilderClient(epo_ops.Client):
         #         if abstract" in "%s" % finding_abstract:
         #
 
-        fullfiled_patent = client.patent(  # Retrieve bibliography data
+        _, fullfiled_patent = self._fetch_patent(  # Retrieve bibliography data
             input = epo_ops.models.Docdb(best_patent_to_fetch.number, best_patent_to_fetch.country, best_patent_to_fetch.kind),  # original, docdb, epodoc
             )
 
-        return family_patents_list, fullfiled_patent
+        return json_fetched, (family_patents_list, fullfiled_patent)
+
+    def family(self, *args, **kwargs):
+        r"""
+        Retrieve the family of a patent, with the biblio of its best patent
+        :Keyword Arguments:
+            * *input* (``epo_ops.models``) --
+        """
+        self.json_parsed, family = self._fetch_family(*args, **kwargs)
+        return family
 
     def _fetch_search_in_range(self, *args, **kwargs):
-        kwargs['constituents'] = ['biblio']  # we always want biblio
+        """ fetch and parse a search result page """
+        key = ('search', kwargs['cql'], kwargs.get('range_begin'), kwargs.get('range_end'), bool(kwargs.get('id_only')))
+        self.json_parsed, results = self.single_flight.do(key, self._request_search_in_range, *args, **kwargs)
+        return results
+
+    def _request_search_in_range(self, *args, **kwargs):
+        # we want biblio, unless only the numbers and the family ids are asked
+        id_only = kwargs.pop('id_only', False)
+        kwargs['constituents'] = [] if id_only else ['biblio']
         logger_epo.debug("Doing an API search with {}".format(kwargs))
         request = super().published_data_search(*args, **kwargs)
-        json_fetched = request.content
-
-        try:
-            self.json_parsed = json.loads(json_fetched)
-        except ValueError as e:
-            raise ValueError("Value error for : %s" % request.content) from e
-
-        try:
-            json_parsed = self.json_parsed['ops:world-patent-data']
-        except KeyError:
-            # this should not happens
-            raise
+        json_fetched = self._load_json(request)
+        json_parsed = json_fetched['ops:world-patent-data']
 
         results = EspacenetSearchResult(json_parsed)
 
         if results.total_count == 0:
             results.patent_families = PatentFamilies()
+        elif id_only:
+            results.patent_families = self._parse_search_references(
+                json_parsed['ops:biblio-search']['ops:search-result']['ops:publication-reference'])
         else:
             # fullfil results with a families patents dict
             patent_families = PatentFamilies()
@@ -244,7 +742,24 @@ class EspacenetBuilderClient(epo_ops.Client):
 
             results.patent_families = patent_families
 
-        return results
+        return json_fetched, results
+
+    def _parse_search_references(self, publication_references):
+        """ the families of a search without biblio, their patents have only their number """
+        if not isinstance(publication_references, (tuple, list)):
+            publication_references = [publication_references]
+
+        patent_families = PatentFamilies()
+        for publication_reference in publication_references:
+            family_id = publication_reference.get('@family-id')
+            patent_object = EspacenetPatent(publication_reference=publication_reference, family_id=family_id)
+            patent_families[family_id].append(patent_object)
+
+        logger_epo.debug("Found {} patent ids in {} families".format(
+            len(patent_families.patents),
+            len(patent_families)
+        ))
+        return patent_families
 
     def published_data_search_with_range(self, *args, **kwargs):
         r"""
@@ -254,72 +769,202 @@ class EspacenetBuilderClient(epo_ops.Client):
                 search value
             * *range_begin* (``int``) --
             * *range_end* (``int``) --
+            * *id_only* (``bool``) --
+                only the numbers and the family ids of the patents, without their biblio
         """
         return self._fetch_search_in_range(*args, **kwargs)
 
+    def _fetch_at_once(self, func, items):
+        """ func(item) for all these items, at the same time as the search throttle allows, in order """
+        if len(items) < 2:
+            return [func(item) for item in items]
+
+        with ThreadPoolExecutor(max_workers=min(len(items), SEARCH_MAX_WORKERS)) as executor:
+            return list(executor.map(func, items))
+
+    def _fetch_first_page(self, cql, id_only=False):
+        """ the first page of a search, an empty page when OPS has nothing for it """
+        try:
+            return self._fetch_search_in_range(cql=cql, range_begin=1, range_end=SEARCH_RANGE_SIZE, id_only=id_only)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != requests.codes.not_found:
+                raise
+            # OPS answers a search without result with a 404
+            page = EspacenetSearchResult()
+            page.total_count = 0
+            page.range_begin, page.range_end = 1, 0
+            return page
+
+    def _search_count(self, cql):
+        """ the total count of a search, asked with the smallest range and without biblio """
+        try:
+            request = super().published_data_search(cql=cql, range_begin=1, range_end=1, constituents=[])
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != requests.codes.not_found:
+                raise
+            # OPS answers a search without result with a 404
+            return 0
+        return int(self._load_json(request)['ops:world-patent-data']['ops:biblio-search']['@total-result-count'])
+
+    def _split_search(self, cql, total_count, id_only=False):
+        """
+        the (cql, first page) of the slices of a search of total_count results, by publication dates,
+        with less results than the limit in each of them :
+        by years, and by months for a year that has too many.
+        All that is before SEARCH_SPLIT_FIRST_YEAR is one more slice
+        The slices are only counted, the first page is fetched for the ones kept
+        """
+        kept = []
+        today = datetime.date.today()
+        # the whole search is already known to be too big, start with its halves
+        slices = [(None, SEARCH_SPLIT_FIRST_YEAR * 12 - 1)] + \
+            _split_months(SEARCH_SPLIT_FIRST_YEAR * 12, today.year * 12 + 11)
+
+        while slices:
+            slices_cql = [_months_cql(cql, first_month, last_month) for first_month, last_month in slices]
+            counts = self._fetch_at_once(self._search_count, slices_cql)
+
+            too_big = []
+            for (first_month, last_month), slice_cql, count in zip(slices, slices_cql, counts):
+                if count <= SEARCH_RESULTS_LIMIT:
+                    kept.append(((first_month, last_month), slice_cql, count))
+                elif first_month is None:
+                    raise ValueError("Espacenet has a limit of 10000 elements, and %s has more before %s. "
+                                     "Build a specific query" % (cql, SEARCH_SPLIT_FIRST_YEAR))
+                elif first_month == last_month:
+                    raise ValueError("Espacenet has a limit of 10000 elements, and %s has more in only "
+                                     "one month. Build a specific query" % cql)
+                else:
+                    too_big.extend(_split_months(first_month, last_month))
+
+            logger_epo.debug("Splitting the search, {} slices are done, {} more to try".format(
+                len(kept), len(too_big)))
+            slices = too_big
+
+        slices_count = sum(count for _, _, count in kept)
+        if slices_count < total_count:
+            # like publications without a date, or after this year
+            logger_epo.warning("The slices by dates of the search have {} results of its {}, "
+                               "{} will be missing".format(slices_count, total_count, total_count - slices_count))
+
+        # in the order of the dates, the one before SEARCH_SPLIT_FIRST_YEAR first, without the empty ones
+        slices_cql = [slice_cql for _, slice_cql, count in sorted(
+            kept, key=lambda slice_count: -1 if slice_count[0][0] is None else slice_count[0][0]) if count]
+        first_pages = self._fetch_at_once(lambda slice_cql: self._fetch_first_page(slice_cql, id_only), slices_cql)
+        return list(zip(slices_cql, first_pages))
+
+    def _iter_search_pages(self, *args, **kwargs):
+        """
+        all the pages of a search, in order, split by publication dates past the 10'000 results.
+        The first page gives the total count, the other pages are then fetched in the
+        background, as the search throttle allows, at most SEARCH_MAX_WORKERS ahead of the caller
+        With an on_page_error(range_begin, range_end, exception), a page that fails is
+        given to it and skipped, instead of stopping the search
+        """
+        on_page_error = kwargs.pop('on_page_error', None)
+        logger_epo.info("Searching patents trough EPO API...")
+
+        try:
+            first_page = self._fetch_search_in_range(*args, range_begin=1, range_end=SEARCH_RANGE_SIZE, **kwargs)
+
+            if first_page.total_count > SEARCH_RESULTS_LIMIT:
+                logger_epo.info("The search has {} results, more than Espacenet can give at once, "
+                                "splitting it by publication dates...".format(first_page.total_count))
+                first_pages = self._split_search(kwargs['cql'], first_page.total_count, kwargs.get('id_only', False))
+            else:
+                first_pages = [(kwargs['cql'], first_page)]
+        except requests.exceptions.RequestException as e:
+            if not on_page_error:
+                raise
+            # without the count, nothing else can be asked
+            on_page_error(1, SEARCH_RANGE_SIZE, e)
+            return
+
+        # the other pages of every slice
+        other_ranges = [(cql, page_range) for cql, page in first_pages if page.total_count
+                        for page_range in _search_ranges(page.total_count, page.range_end + 1)]
+
+        if other_ranges:
+            logger_epo.debug("Fetching the {} other pages...".format(len(other_ranges)))
+
+        # no more than SEARCH_MAX_WORKERS pages ahead of the caller, the next one is asked as one is given
+        max_workers = max(1, min(len(other_ranges), SEARCH_MAX_WORKERS))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        pending = iter(other_ranges)
+        in_flight = collections.deque()
+
+        def fetch_next():
+            for cql, (range_begin, range_end) in pending:
+                in_flight.append((range_begin, range_end, executor.submit(
+                    self._fetch_search_in_range, cql=cql, range_begin=range_begin, range_end=range_end,
+                    id_only=kwargs.get('id_only', False))))
+                return
+
+        try:
+            for _ in range(max_workers):
+                fetch_next()
+
+            for _, page in first_pages:
+                yield page
+                if not page.total_count:
+                    continue
+
+                for _ in _search_ranges(page.total_count, page.range_end + 1):
+                    range_begin, range_end, future = in_flight.popleft()
+                    fetch_next()
+                    try:
+                        other_page = future.result()
+                    except requests.exceptions.RequestException as e:
+                        if not on_page_error:
+                            raise
+                        on_page_error(range_begin, range_end, e)
+                        continue
+                    yield other_page
+        finally:
+            # the caller may stop before the end
+            for _, _, future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _merge_search_page(self, families, page):
+        """
+        add the patents of a search page to families, a family can be in more than one page,
+        return the ids of the families that were not in it
+        """
+        new_family_ids = []
+        for family_id, patents in page.patent_families.items():
+            if family_id not in families:
+                new_family_ids.append(family_id)
+            # extend the list of families, never the one of the page, it may be shared with another caller
+            families[family_id].extend(patents)
+        return new_family_ids
+
     def published_data_search(self, *args, **kwargs):
         r"""
         Unlimited search that make multiple requests until
-        all patents have been fetched. Limit is still 10'000 though
+        all patents have been fetched. Past the 10'000 results OPS can give
+        for one query, the query is split by publication dates, see _split_search
 
         :Keyword Arguments:
             * *cql* (``str``) --
                 search value
+            * *id_only* (``bool``) --
+                only the numbers and the family ids of the patents, without their biblio
         """
         final_results = EspacenetSearchResult()
         total_fetched = 0
-        espacenet_range_limit = 10000
-        range_iteration_count = 100
-
-        range_begin = 1
-        range_end = 100
-
-        logger_epo.info("Searching patents trough EPO API...")
 
-        while True:
-            if range_begin > espacenet_range_limit:
-                break
+        for page in self._iter_search_pages(*args, **kwargs):
+            # build one result, in the order of the pages
+            self._merge_search_page(final_results.patent_families, page)
 
-            # set kwargs for _fetch_search_in_range
-            kwargs["range_begin"] = range_begin
-            kwargs["range_end"] = range_end
+            if page.total_count:
+                total_fetched += page.range_end - page.range_begin + 1
 
-            result_patents = self._fetch_search_in_range(*args, **kwargs)
+            # set final results good values
+            final_results.range_begin = page.range_begin
+            final_results.range_end = page.range_end
 
-            # build one result
-            for key, value in result_patents.patent_families.items():
-                if final_results.patent_families.get(key):
-                    final_results.patent_families[key].extend(value)
-                else:
-                    final_results.patent_families[key] = value
-
-            # need more ?
-            total_fetched += result_patents.range_end - result_patents.range_begin + 1
-
-            logger_epo.debug("Done an iteration of fetch {}/{}".format(
-                total_fetched,
-                result_patents.total_count,
-            ))
-
-            if result_patents.total_count > espacenet_range_limit:
-                    raise ValueError("Espacenet has a limit of 10000 "
-                                    "elements. Build a specific query ")
-
-            if result_patents.total_count == 0 or \
-                total_fetched >= result_patents.total_count:
-                break
-
-            # prepare next iteration
-            range_begin += range_iteration_count
-            range_end += range_iteration_count
-            # don't allow over 10000
-            range_end = min(range_end, espacenet_range_limit)
-            if range_end > result_patents.total_count:
-                range_end = result_patents.total_count
-
-        # set final results good values
-        final_results.range_begin = range_begin
-        final_results.range_end = range_end
         final_results.total_count = total_fetched
 
         logger_epo.debug("Search result : Found {} patents inside {} uniq families".format(
@@ -329,12 +974,76 @@ class EspacenetBuilderClient(epo_ops.Client):
 
         return final_results
 
-    def search(self, value, range_begin=None, range_end=None):
-        """ Entry method that decide if auto_range is needed """
+    def iter_search(self, cql, id_only=False, on_page_error=None):
+        r"""
+        Search like published_data_search, but give the families page by page,
+        while the next pages are still downloading
+        A family is given once, in the batch of the page where it is first found.
+        The members found in the next pages are added to the same list,
+        so the families are complete once the iteration is over
+
+        :Arguments:
+            * *cql* (``str``) --
+                search value
+            * *id_only* (``bool``) --
+                only the numbers and the family ids of the patents, without their biblio
+            * *on_page_error* (``func(range_begin, range_end, exception)``) --
+                called for a page that fails, like one not in the cache when offline,
+                the search goes on without it. Without it, the exception is raised
+        Yield a PatentFamilies by page, with the families new in it
+        """
+        families = PatentFamilies()
+
+        for page in self._iter_search_pages(cql=cql, id_only=id_only, on_page_error=on_page_error):
+            batch = PatentFamilies()
+            for family_id in self._merge_search_page(families, page):
+                batch[family_id] = families[family_id]
+
+            logger_epo.debug("Search page {}-{} gives {} new families".format(
+                page.range_begin, page.range_end, len(batch)))
+            yield batch
+
+    def count(self, cql):
+        r"""
+        How many results a search has, without getting them
+        Only the smallest range is asked, without biblio, and nothing but the count is read
+        :Arguments:
+            * *cql* (``str``) --
+                search value
+        Return a SearchCount of the total count, the pages needed to get the results,
+        and the OPS calls the search would do. Past the 10'000 results, the search is split
+        by publication dates, and how is only known by doing it : request_count is then only
+        a lower bound, one call for every page, the first page of the whole search, and the
+        counts of the first three slices, see _split_search. Each slice too big to be kept
+        costs two more
+        The count is always asked to OPS, never served from the cache
+        """
+        with self.cache.fresh() if self.cache else contextlib.nullcontext():
+            total_count = self._search_count(cql)
+
+        page_count = -(-total_count // SEARCH_RANGE_SIZE)
+        if total_count > SEARCH_RESULTS_LIMIT:
+            # see _split_search, the slices have all the pages between them
+            request_count = page_count + 4
+        else:
+            # a search without result asks its first page anyway
+            request_count = max(1, page_count)
+
+        logger_epo.debug("The search {} has {} results, in {} pages".format(cql, total_count, page_count))
+
+        return SearchCount(total_count, page_count, request_count)
+
+    def search(self, value, range_begin=None, range_end=None, id_only=False):
+        """
+        Entry method that decide if auto_range is needed
+        With id_only, the patents have only their number and their family id,
+        for a fraction of the download of their biblio
+        """
         if range_begin and range_end:
             return self.published_data_search_with_range(
                 cql = value,
                 range_begin = range_begin,
-                range_end = range_end)
+                range_end = range_end,
+                id_only = id_only)
         else:
-            return self.published_data_search(cql = value)
+            return self.published_data_search(cql = value, id_only = id_only)
@@ -1,12 +1,22 @@
+import re
+import datetime
+import json
+import time
 import unittest
+import threading
 import tempfile
+from unittest import mock
 
 import epo_ops
+import requests
 
 from .marc import MarcRecord, MarcCollection, MarcRecordBuilder
 from .models import EspacenetPatent
-from .patent_models import PatentFamilies
-from .builder import EspacenetBuilderClient
+from .patent_models import PatentFamilies, Patent
+from .builder import EspacenetBuilderClient, EspacenetSearchResult, SearchCount, get_client, reset_clients, _search_ranges
+from .cache import CacheEntry, NotInCacheError
+from .testing import TemporaryDataDirTestCase
+from .token_store import StoredAccessToken
 from .utils import p_json
 
 
@@ -107,6 +117,442 @@ class TestEspacenetBuilderStructure(unittest.TestCase):
         bibliographic_data = exchange_document['bibliographic-data']
 
 
+class TestSharedClient(TemporaryDataDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(reset_clients)
+
+    def test_should_share_the_same_client(self):
+        client = get_client()
+        self.assertIsInstance(client, EspacenetBuilderClient)
+        self.assertIs(client, get_client(use_cache=True))
+        self.assertIs(client.session, client.request.session)
+
+    def test_should_not_share_client_with_other_settings(self):
+        self.assertIsNot(get_client(), get_client(use_cache=False))
+        self.assertIsNot(get_client(), get_client(pool_size=2))
+
+    def test_should_build_new_clients_after_reset(self):
+        client = get_client()
+        reset_clients()
+        self.assertIsNot(client, get_client())
+
+
+def family_content(*members):
+    """ a family response, with its members as (country, number, kind, date) """
+    return json.dumps({'ops:world-patent-data': {'ops:patent-family': {'ops:family-member': [
+        {'@family-id': '1', 'publication-reference': {'document-id': [
+            {'@document-id-type': 'docdb', 'country': {'$': country}, 'doc-number': {'$': number},
+             'kind': {'$': kind}, 'date': {'$': date}},
+        ]}} for country, number, kind, date in members
+    ]}}}).encode('utf-8')
+
+
+class FakeOpsTestCase(TemporaryDataDirTestCase):
+    """
+    A client with all its files in a temporary data directory, and a fake
+    OPS behind its session, so the calls go through all the middlewares
+    OPS answers what is given to answer_with, and self.calls has what it got
+    """
+    client_kwargs = {}
+
+    def setUp(self):
+        super().setUp()
+
+        kwargs = {'key': 'key', 'secret': 'secret'}
+        kwargs.update(self.client_kwargs)
+        self.client = EspacenetBuilderClient(**kwargs)
+        self.addCleanup(self.client.close)
+        if self.client.use_network:
+            self.client._access_token = StoredAccessToken('token', time.time() + 3600)
+
+        self.calls = []  # (url, data, headers) OPS has got
+        self.client.session.post = self.ops_post
+        self.answer_with(b'{}')
+
+    def answer_with(self, content, status_code=200):
+        """ content, or a func(url, data) giving it or (content, status_code), is what OPS answers """
+        self.answer = (content, status_code)
+
+    def ops_post(self, url, data=None, headers=None, params=None):
+        self.calls.append((url, data, headers))
+        content, status_code = self.answer
+        if callable(content):
+            content = content(url, data)
+            if isinstance(content, tuple):
+                content, status_code = content
+
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = 'OK' if status_code == 200 else 'Error'
+        response.url = url
+        response.headers['Content-Type'] = 'application/json'
+        response._content = content
+        return response
+
+
+class TestFamilyRevalidation(FakeOpsTestCase):
+    member = ('EP', '2936195', 'B1', '20170301')
+
+    def setUp(self):
+        super().setUp()
+        self.input = epo_ops.models.Epodoc('EP2936195')
+        self.url = self.client._make_request_url(
+            self.client.__family_path__, 'publication', self.input, 'biblio', [])
+        self.key = self.client.cache.generate_key(self.url, self.input.as_api_input())
+        self.client.cache.backend.set(self.key, CacheEntry(
+            200, 'OK', self.url, {}, family_content(self.member), 0, time.time() - 60))
+
+    def ask_the_stale_family(self):
+        """ get the family as any caller would, and wait for its refresh in background """
+        response = self.client._make_request(self.url, self.input.as_api_input())
+        self.assertEqual(response.content, family_content(self.member))
+        self.assertEqual(self.calls, [])
+
+        deadline = time.monotonic() + 5
+        while self.client.cache.revalidations < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.client.cache.revalidations, 1)
+
+    def test_should_keep_an_unchanged_family(self):
+        self.answer_with(family_content(self.member))
+        self.ask_the_stale_family()
+
+        self.assertEqual([url for url, _, _ in self.calls], [self.url[:-len('/biblio')]])
+        # fresh again, without downloading the biblio
+        self.assertIsNotNone(self.client.cache.backend.get(self.key))
+        self.assertEqual(self.client.cache.unchanged, 1)
+
+    def test_should_download_a_changed_family(self):
+        changed = family_content(self.member, ('US', '10000000', 'B2', '20180601'))
+        self.answer_with(changed)
+        self.ask_the_stale_family()
+
+        self.assertEqual([url for url, _, _ in self.calls], [self.url[:-len('/biblio')], self.url])
+        self.assertEqual(self.client.cache.backend.get(self.key).body, changed)
+
+
+class TestOfflineClient(FakeOpsTestCase):
+    client_kwargs = {'use_network': False}
+
+    def biblio_content(self, number):
+        return json.dumps({'ops:world-patent-data': {'exchange-documents': {'exchange-document': {
+            '@country': 'EP', '@doc-number': number, '@kind': 'B1'}}}}).encode('utf-8')
+
+    def test_should_not_call_ops_offline(self):
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.client.patent(input=epo_ops.models.Docdb('0000001', 'XX', 'A1'))
+
+        self.assertEqual(self.calls, [])
+        self.assertIsNone(self.client._access_token)
+        self.assertGreater(len(self.client.cache.offline_misses), 0)
+
+    def test_should_serve_a_bulk_from_the_cached_patents(self):
+        # the biblio parsing is tested with OPS, keep the raw documents
+        self.client._parse_exchange_document = lambda exchange_document: exchange_document
+        inputs = [epo_ops.models.Epodoc('EP2936195'), epo_ops.models.Epodoc('EP1000000')]
+        for input in reversed(inputs):
+            url = self.client._make_request_url(
+                self.client.__published_data_path__, 'publication', input, 'biblio', [])
+            self.client.cache.store(url, input.as_api_input(), 200, 'OK',
+                                    {'Content-Type': 'application/json'}, self.biblio_content(input.number[2:]))
+
+        patents = self.client.patents_bulk(inputs)
+
+        self.assertEqual(list(patents.keys()), inputs)
+        self.assertEqual(patents[inputs[0]]['@doc-number'], '2936195')
+        self.assertEqual(self.calls, [])
+
+    def test_should_give_the_cached_patents_of_a_bulk_with_some_not_cached(self):
+        self.client._parse_exchange_document = lambda exchange_document: exchange_document
+        cached, not_cached = epo_ops.models.Epodoc('EP2936195'), epo_ops.models.Epodoc('EP1000000')
+        url = self.client._make_request_url(
+            self.client.__published_data_path__, 'publication', cached, 'biblio', [])
+        self.client.cache.store(url, cached.as_api_input(), 200, 'OK',
+                                {'Content-Type': 'application/json'}, self.biblio_content('2936195'))
+
+        patents = self.client.patents_bulk([not_cached, cached])
+
+        self.assertEqual(list(patents.keys()), [cached])
+        self.assertEqual(self.calls, [])
+        self.assertEqual(len(self.client.cache.offline_misses), 1)
+
+    def test_should_go_on_without_the_pages_not_cached(self):
+        skipped = []
+        batches = list(self.client.iter_search(
+            'pa all "Ecole Polytech* Lausanne"',
+            on_page_error=lambda range_begin, range_end, e: skipped.append((range_begin, range_end, e))))
+
+        self.assertEqual(batches, [])
+        self.assertEqual([(range_begin, range_end) for range_begin, range_end, _ in skipped], [(1, 100)])
+        self.assertIsInstance(skipped[0][2], NotInCacheError)
+        self.assertEqual(self.calls, [])
+
+
+class TestBulkSplit(FakeOpsTestCase):
+    documents = [
+        {'@country': 'EP', '@doc-number': '2936195', '@kind': 'B1'},
+        {'@country': 'WO', '@doc-number': '2017102593', '@kind': 'A1'},
+        {'@country': 'US', '@doc-number': '10000000', '@kind': 'B2', '@status': 'not found'},
+    ]
+
+    def setUp(self):
+        super().setUp()
+        # the biblio parsing is tested with OPS, keep the raw documents
+        self.client._parse_exchange_document = lambda exchange_document: exchange_document
+        self.answer_with(json.dumps({'ops:world-patent-data': {'exchange-documents': [
+            {'exchange-document': document} for document in self.documents
+        ]}}).encode('utf-8'))
+
+    def cached(self, input):
+        url = self.client._make_request_url(
+            self.client.__published_data_path__, 'publication', input, 'biblio', [])
+        return self.client.cache.backend.get(self.client.cache.generate_key(url, input.as_api_input()))
+
+    def test_should_cache_each_document_of_a_bulk(self):
+        inputs = [
+            epo_ops.models.Epodoc('EP2936195'),
+            epo_ops.models.Epodoc('WO2017102593'),
+            epo_ops.models.Epodoc('US10000000'),
+        ]
+        patents = self.client.patents_bulk(inputs)
+        self.assertEqual(list(patents.keys()), inputs[:2])
+
+        entry = self.cached(inputs[0])
+        self.assertIsNotNone(entry)
+        self.assertEqual(json.loads(entry.body)['ops:world-patent-data']['exchange-documents'],
+                         {'exchange-document': self.documents[0]})
+        # and under its docdb, as a call of its own would have been
+        self.assertIsNotNone(self.cached(epo_ops.models.Docdb('2936195', 'EP', 'B1')))
+
+        self.assertIsNotNone(self.cached(inputs[1]))
+        self.assertIsNone(self.cached(inputs[2]))
+        self.assertEqual(len(self.calls), 1)
+
+
+class TestSearchPages(FakeOpsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.asked = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def answer_counts(self, count_for_cql):
+        """
+        answer with count_for_cql(cql) results, every page has its family and a shared one,
+        the counts are asked to the fake OPS, the pages to a stand-in of _request_search_in_range
+        """
+        def count(url, data):
+            total_count = count_for_cql(data['q'])
+            return json.dumps({'ops:world-patent-data': {'ops:biblio-search': {
+                '@total-result-count': str(total_count),
+            }}}).encode('utf-8'), 200 if total_count else 404
+        self.answer_with(count)
+
+        def request_search_in_range(cql, range_begin, range_end, id_only=False):
+            with self.lock:
+                self.asked.append((cql, range_begin, range_end))
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            time.sleep(0.01)
+            with self.lock:
+                self.in_flight -= 1
+
+            total_count = count_for_cql(cql)
+            if not total_count:
+                response = requests.Response()
+                response.status_code = 404
+                raise requests.exceptions.HTTPError("No results found", response=response)
+
+            page = EspacenetSearchResult()
+            page.total_count = total_count
+            page.range_begin = range_begin
+            page.range_end = min(range_end, total_count)
+            page.patent_families['family-%s-%s' % (cql, range_begin)].append(
+                Patent(epodoc='EP%s' % len(self.asked)))
+            page.patent_families['shared'].append(Patent(epodoc='EP%s' % range_begin))
+            return {}, page
+        self.client._request_search_in_range = request_search_in_range
+
+    def count_by_months(self, by_month, cql):
+        """ the results of a cql, from the counts of {(year, month): count} """
+        before = re.search(r'pd<(\d{4})(\d{2})\d{2}', cql)
+        within = re.search(r'pd within "(\d{4})(\d{2})\d{2} (\d{4})(\d{2})\d{2}"', cql)
+        if before:
+            return sum(count for month, count in by_month.items() if month < (int(before.group(1)), int(before.group(2))))
+        if within:
+            first, last = (int(within.group(1)), int(within.group(2))), (int(within.group(3)), int(within.group(4)))
+            return sum(count for month, count in by_month.items() if first <= month <= last)
+        return sum(by_month.values())
+
+    def test_should_split_the_ranges(self):
+        self.assertEqual(_search_ranges(250), [(1, 100), (101, 200), (201, 250)])
+        self.assertEqual(_search_ranges(250, 101), [(101, 200), (201, 250)])
+        self.assertEqual(_search_ranges(100, 101), [])
+        self.assertEqual(_search_ranges(20000)[-1], (9901, 10000))
+
+    def test_should_fetch_the_other_pages_at_once(self):
+        self.answer_counts(lambda cql: 450)
+        results = self.client.published_data_search(cql='pa=epfl')
+
+        ranges = [(begin, end) for _, begin, end in self.asked]
+        self.assertEqual(ranges[0], (1, 100))
+        self.assertEqual(sorted(ranges), [(1, 100), (101, 200), (201, 300), (301, 400), (401, 450)])
+        self.assertGreater(self.max_in_flight, 1)
+
+        self.assertEqual(results.total_count, 450)
+        # merged in the order of the pages
+        self.assertEqual([patent.epodoc for patent in results.patent_families['shared']],
+                         ['EP1', 'EP101', 'EP201', 'EP301', 'EP401'])
+        self.assertEqual(list(results.patent_families.keys())[:2], ['family-pa=epfl-1', 'shared'])
+
+    def test_should_split_by_publication_dates_past_the_limit(self):
+        # 300 results by month in 2015, 1000 by month in 2016
+        by_month = {(2015, month): 300 for month in range(1, 13)}
+        by_month.update({(2016, month): 1000 for month in range(1, 13)})
+
+        by_month[(1899, 12)] = 50
+
+        self.answer_counts(lambda cql: self.count_by_months(by_month, cql))
+        results = self.client.published_data_search(cql='pa=epfl')
+
+        self.assertEqual(results.total_count, 300 * 12 + 1000 * 12 + 50)
+        counted = [data['q'] for _, data, _ in self.calls]
+        # the slices are only counted, with the smallest range and without biblio
+        for url, _, headers in self.calls:
+            self.assertFalse(url.endswith('/biblio'))
+            self.assertEqual(headers['X-OPS-Range'], '1-1')
+        # no slice has asked for more than the limit
+        for cql, begin, end in self.asked:
+            self.assertLessEqual(end, 10000)
+        # 2016 alone is too big, its months have been counted
+        self.assertIn('(pa=epfl) and pd within "20160101 20160630"', counted)
+        # the whole range of dates has the count of the search, it is not counted again
+        self.assertFalse(any('"19000101 %s1231"' % datetime.date.today().year in cql for cql in counted))
+        # the old ones are not left out
+        self.assertIn('family-(pa=epfl) and pd<19000101-1', results.patent_families)
+
+        # pages are fetched only for the slices kept, and the first page of the whole search
+        self.assertEqual(self.asked[0][0], 'pa=epfl')
+        for cql, _, _ in self.asked[1:]:
+            self.assertTrue(0 < self.count_by_months(by_month, cql) <= 10000)
+        self.assertEqual(len(results.patent_families['shared']), len(self.asked) - 1)
+
+    def test_should_warn_about_the_results_without_a_slice(self):
+        by_month = {(2016, month): 1000 for month in range(1, 13)}
+        # and 500 without a publication date
+        self.answer_counts(lambda cql: self.count_by_months(by_month, cql) + (0 if ' pd' in cql else 500))
+
+        with self.assertLogs('EPO', 'WARNING') as logs:
+            self.client.published_data_search(cql='pa=epfl')
+        self.assertIn('12000 results of its 12500, 500 will be missing', '\n'.join(logs.output))
+
+    def test_should_give_the_families_page_by_page(self):
+        self.answer_counts(lambda cql: 250)
+        batches = self.client.iter_search('pa=epfl')
+
+        first_batch = next(batches)
+        self.assertEqual(list(first_batch.keys()), ['family-pa=epfl-1', 'shared'])
+        self.assertEqual(len(first_batch['shared']), 1)
+
+        other_batches = list(batches)
+        self.assertEqual(len(other_batches), 2)
+        # the shared family is given once, and gets the members of the next pages
+        self.assertNotIn('shared', other_batches[0])
+        self.assertEqual([patent.epodoc for patent in first_batch['shared']], ['EP1', 'EP101', 'EP201'])
+
+    def test_should_keep_every_publication_of_a_family(self):
+        page = EspacenetSearchResult()
+        page.patent_families['54'].extend([Patent(country='EP', number='2936195', kind='A1'),
+                                           Patent(country='EP', number='2936195', kind='B1')])
+        families = PatentFamilies()
+
+        self.assertEqual(self.client._merge_search_page(families, page), ['54'])
+        self.assertEqual([(patent.epodoc, patent.kind) for patent in families['54']],
+                         [('EP2936195', 'A1'), ('EP2936195', 'B1')])
+        # the page is left as it is
+        self.assertEqual(len(page.patent_families['54']), 2)
+
+    def test_should_keep_only_a_few_pages_ahead_of_the_caller(self):
+        self.answer_counts(lambda cql: 2000)
+        with mock.patch('Espacenet.builder.SEARCH_MAX_WORKERS', 3):
+            batches = self.client.iter_search('pa=epfl')
+            next(batches)
+            next(batches)
+            time.sleep(0.1)
+            # the first page, the one given after it, and 3 more
+            self.assertEqual(len(self.asked), 5)
+            self.assertLessEqual(self.max_in_flight, 3)
+
+            self.assertEqual(len(list(batches)), 18)
+        self.assertEqual(len(self.asked), 20)
+
+    def test_should_refuse_too_many_results_in_a_month(self):
+        self.answer_counts(lambda cql: 10001)
+        with self.assertRaises(ValueError):
+            self.client.published_data_search(cql='pa=epfl')
+
+
+class TestIdOnlySearch(FakeOpsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.answer_with(lambda url, data: json.dumps({'ops:world-patent-data': {'ops:biblio-search': {
+            '@total-result-count': '2',
+            'ops:query': {'$': data['q']},
+            'ops:range': {'@begin': '1', '@end': '2'},
+            'ops:search-result': {'ops:publication-reference': [
+                {'@family-id': '54', 'document-id': {
+                    '@document-id-type': 'docdb', 'country': {'$': 'EP'},
+                    'doc-number': {'$': '2936195'}, 'kind': {'$': 'B1'}}},
+                {'@family-id': '54', 'document-id': {
+                    '@document-id-type': 'docdb', 'country': {'$': 'WO'},
+                    'doc-number': {'$': '2017102593'}, 'kind': {'$': 'A1'}}},
+            ]},
+        }}}).encode('utf-8'))
+
+    def test_should_search_without_biblio(self):
+        results = self.client.search('pa=epfl', id_only=True)
+
+        self.assertFalse(self.calls[0][0].endswith('/biblio'))
+        self.assertEqual(list(results.patent_families.keys()), ['54'])
+        self.assertEqual([(patent.country, patent.number, patent.kind) for patent in results.patent_families['54']],
+                         [('EP', '2936195', 'B1'), ('WO', '2017102593', 'A1')])
+        self.assertEqual(results.patent_families['54'][0].family_id, '54')
+
+
+class TestSearchCount(FakeOpsTestCase):
+    def answer_count(self, total_count):
+        self.answer_with(json.dumps({'ops:world-patent-data': {'ops:biblio-search': {
+            '@total-result-count': str(total_count),
+        }}}).encode('utf-8'), 200 if total_count else 404)
+
+    def test_should_count_with_the_smallest_range(self):
+        self.answer_count(250)
+        self.assertEqual(self.client.count('pa=epfl'), SearchCount(250, 3, 3))
+
+        url, _, headers = self.calls[0]
+        self.assertFalse(url.endswith('/biblio'))
+        self.assertEqual(headers['X-OPS-Range'], '1-1')
+
+    def test_should_count_the_split_searches(self):
+        self.answer_count(12345)
+        # at least, the split itself is not known
+        self.assertEqual(self.client.count('pa=epfl'), SearchCount(12345, 124, 128))
+
+    def test_should_always_ask_ops(self):
+        self.answer_count(250)
+        self.client.count('pa=epfl')
+        self.answer_count(300)
+
+        self.assertEqual(self.client.count('pa=epfl').total_count, 300)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_should_count_no_result(self):
+        self.answer_count(0)
+        self.assertEqual(self.client.count('pa=nobody'), SearchCount(0, 0, 1))
+
+
 def is_patent_from_epfl(patent):
     """ check if the patent has any link with the epfl """
     valid_applicants = ['ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE (EPFL)',
@@ -139,6 +585,31 @@ class TestEspacenetBuilder(unittest.TestCase):
         self.assertGreater(len(patent.inventors), 0)
         self.assertNotEqual(patent.inventors[0], '')
 
+    def test_should_fetch_patents_in_bulk(self):
+        inputs = [
+            epo_ops.models.Docdb('1000000', 'EP', 'A1'),
+            epo_ops.models.Epodoc('EP2936195'),
+            epo_ops.models.Epodoc('WO2017102593'),
+        ]
+        patents = self.__class__.client.patents_bulk(inputs)
+
+        self.assertEqual(len(patents), 3)
+        self.assertEqual(list(patents.keys()), inputs)
+        self.assertEqual(patents[inputs[0]].epodoc, 'EP1000000')
+        self.assertEqual(patents[inputs[1]].epodoc, 'EP2936195')
+        self.assertEqual(patents[inputs[2]].epodoc, 'WO2017102593')
+        self.assertNotEqual(patents[inputs[2]].abstract_en, '')
+
+    def test_should_match_bulk_documents_to_inputs(self):
+        client = self.__class__.client
+        exchange_document = {'@country': 'EP', '@doc-number': '2936195', '@kind': 'B1'}
+
+        self.assertTrue(client._input_matches(epo_ops.models.Epodoc('EP2936195'), exchange_document))
+        self.assertTrue(client._input_matches(epo_ops.models.Epodoc('EP2936195', 'B1'), exchange_document))
+        self.assertTrue(client._input_matches(epo_ops.models.Docdb('2936195', 'EP', 'B1'), exchange_document))
+        self.assertFalse(client._input_matches(epo_ops.models.Docdb('2936195', 'EP', 'A1'), exchange_document))
+        self.assertFalse(client._input_matches(epo_ops.models.Epodoc('EP2936196'), exchange_document))
+
     def test_should_fetch_inventor_unicode_correctly(self):
         patents_family, fulfilled_patent = self.__class__.client.family(  # Retrieve bibliography data
                 input = epo_ops.models.Epodoc('EP3487508'),  # original, docdb, epodoc
@@ -0,0 +1,717 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import collections
+import contextlib
+import gzip
+import json
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import epo_ops
+from epo_ops.middlewares import Middleware
+from epo_ops.middlewares.cache.dogpile.helpers import kwarg_range_header_handler
+
+from .settings import data_path, CACHE_URL
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib does the job too
+    zstandard = None
+
+logger_epo = logging.getLogger('EPO')
+
+# how long an OPS response is served from the cache
+DEFAULT_CACHE_TTL = 60 * 60 * 24 * 7 * 2  # two weeks
+
+# how long after its ttl an entry can still be served, while it is refreshed in background
+DEFAULT_MAX_STALE = 60 * 60 * 24 * 7 * 6  # six weeks
+
+# the endpoints whose entries can be served stale, a biblio or a family rarely changes
+STALE_SERVED_ENDPOINTS = ('published-data', 'family')
+
+# searches are how new publications are found, they are kept a day, and never served stale
+SEARCH_CACHE_TTL = 60 * 60 * 24  # one day
+
+# the most stale entries waiting for a refresh, the others wait for a next run
+MAX_PENDING_REVALIDATIONS = 1000
+
+# how many entries of a bundle are written at once
+BUNDLE_IMPORT_BATCH = 500
+
+# same as the epo_ops Dogpile middleware
+CACHEABLE_STATUS_CODES = (
+    requests.codes.ok,  # 200
+    requests.codes.not_found,  # 404
+    requests.codes.method_not_allowed,  # 405
+    requests.codes.request_entity_too_large,  # 413
+)
+
+# like https://ops.epo.org/3.2/rest-services/published-data/publication/docdb/biblio
+PUBLICATION_URL_REGEX = \
+    r'^(?P<prefix>.*/(?P<service>published-data|family)/publication)/(?P<input_format>epodoc|docdb)(?P<rest>/.*)?$'
+
+# like https://ops.epo.org/3.2/rest-services/published-data/search/biblio
+ENDPOINT_URL_REGEX = r'/rest-services/(?P<service>[\w-]+)(?P<search>/search)?'
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def compress(body):
+    """ compress a response body with the best codec we have, return (codec, data) """
+    if zstandard:
+        return 'zstd', zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return 'zlib', zlib.compress(body, ZLIB_LEVEL)
+
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        if not zstandard:
+            raise ValueError("This cache entry needs zstandard to be installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    return data
+
+
+def publication_key(input_format, api_input, with_kind=True):
+    """
+    The identity of one publication, whatever the input format, like EP2936195
+    for Epodoc('EP2936195') and EP2936195.B1 for Docdb('2936195', 'EP', 'B1')
+    None when we can't be sure (many inputs, a date, an original, ...)
+    """
+    if not api_input or '\n' in api_input:
+        return None
+
+    parts = [urllib.parse.unquote(part).replace(' ', '').upper()
+             for part in re.findall(r'\(([^)]*)\)', api_input)]
+
+    if input_format == 'docdb' and len(parts) == 3:
+        country, number, kind = parts
+        publication = country + number
+    elif input_format == 'epodoc' and len(parts) in (1, 2):
+        publication = parts[0]
+        kind = parts[1] if len(parts) == 2 else None
+    else:
+        return None
+
+    if with_kind and kind:
+        return '%s.%s' % (publication, kind)
+    return publication
+
+
+def endpoint_for_url(url):
+    """ the OPS endpoint of a call, like published-data, published-data/search or family """
+    matched = re.search(ENDPOINT_URL_REGEX, url or '')
+    if not matched:
+        return 'other'
+    return matched.group('service') + (matched.group('search') or '')
+
+
+def _single_exchange_document(content):
+    """ the exchange-document of a biblio response, if it has only one """
+    try:
+        exchange_documents = json.loads(content)['ops:world-patent-data']['exchange-documents']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    if isinstance(exchange_documents, list):
+        if len(exchange_documents) != 1:
+            return None
+        exchange_documents = exchange_documents[0]
+
+    exchange_document = exchange_documents.get('exchange-document')
+    if isinstance(exchange_document, list):
+        if len(exchange_document) != 1:
+            return None
+        exchange_document = exchange_document[0]
+
+    return exchange_document
+
+
+class NotInCacheError(requests.exceptions.HTTPError):
+    """ offline, and this call is not in the cache """
+
+
+CacheEntry = collections.namedtuple(
+    'CacheEntry', ['status', 'reason', 'url', 'headers', 'body', 'created_at', 'expires_at'])
+
+
+class CacheBackend(object):
+    """
+    What the backends share: the bodies are stored compressed, see compress,
+    and what it gives in this run is counted
+    """
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self.raw_bytes = 0  # written in this run, before compression
+        self.stored_bytes = 0  # and after
+        self.decodes = 0
+        self.decode_time = 0.
+
+    def _compress(self, body):
+        codec, data = compress(body)
+        with self._stats_lock:
+            self.raw_bytes += len(body)
+            self.stored_bytes += len(data)
+        return codec, data
+
+    def _decompress(self, codec, data):
+        started = time.perf_counter()
+        body = decompress(codec, data)
+        with self._stats_lock:
+            self.decodes += 1
+            self.decode_time += time.perf_counter() - started
+        return body
+
+    def close(self):
+        pass
+
+    def run_stats(self):
+        return {
+            'run_compression_ratio': self.raw_bytes / self.stored_bytes if self.stored_bytes else None,
+            'run_decodes': self.decodes,
+            'run_decode_time': self.decode_time,
+        }
+
+
+class SqliteBackend(CacheBackend):
+    """
+    The cached responses in a single SQLite file, in WAL mode, so readers
+    never wait for the writer. Every entry is written in one statement,
+    and has its own expiration time
+    The hits and misses of all the runs are kept by endpoint, see record_lookups
+    """
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path or data_path('cache.db')
+
+        db = self._connect()
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS responses(
+                    key text primary key,
+                    status integer,
+                    reason text,
+                    url text,
+                    headers text,
+                    body blob,
+                    created_at real,
+                    expires_at real,
+                    codec text,
+                    endpoint text
+                )""")
+            # a cache from before the compression, or the stats by endpoint
+            columns = [row[1] for row in db.execute('PRAGMA table_info(responses)')]
+            if 'codec' not in columns:
+                db.execute("ALTER TABLE responses ADD COLUMN codec text DEFAULT 'identity'")
+            if 'endpoint' not in columns:
+                db.execute("ALTER TABLE responses ADD COLUMN endpoint text")
+
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS lookups(
+                    endpoint text primary key,
+                    hits integer,
+                    misses integer
+                )""")
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def _entry_from_row(self, row):
+        status, reason, url, headers, body, created_at, expires_at, codec = row
+        body = self._decompress(codec, bytes(body))
+        return CacheEntry(status, reason, url, json.loads(headers), body, created_at, expires_at)
+
+    def get(self, key, now=None, max_stale=0):
+        """ the CacheEntry of this key, None if there is none or it has expired for more than max_stale """
+        db = self._connect()
+        try:
+            row = db.execute(
+                'SELECT status, reason, url, headers, body, created_at, expires_at, codec '
+                'FROM responses WHERE key = ? AND expires_at > ?',
+                (key, (now or time.time()) - max_stale)).fetchone()
+        finally:
+            db.close()
+
+        if row:
+            return self._entry_from_row(row)
+
+    def items(self):
+        """ all the (key, CacheEntry) we have, expired or not """
+        db = self._connect()
+        try:
+            for row in db.execute(
+                    'SELECT key, status, reason, url, headers, body, created_at, expires_at, codec '
+                    'FROM responses ORDER BY key'):
+                yield row[0], self._entry_from_row(row[1:])
+        finally:
+            db.close()
+
+    def set(self, key, entry):
+        self.set_many([(key, entry)])
+
+    def set_many(self, items, only_newer=False):
+        """
+        write all these (key, CacheEntry) at once,
+        with only_newer an entry does not replace a more recent one
+        """
+        rows = []
+        for key, entry in items:
+            codec, body = self._compress(entry.body)
+            rows.append((key, entry.status, entry.reason, entry.url, json.dumps(entry.headers),
+                         sqlite3.Binary(body), entry.created_at, entry.expires_at, codec,
+                         endpoint_for_url(entry.url)))
+
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            if only_newer:
+                newer = set()
+                for row in rows:
+                    found = db.execute('SELECT created_at FROM responses WHERE key = ?', (row[0],)).fetchone()
+                    if found and found[0] >= row[6]:
+                        newer.add(row[0])
+                rows = [row for row in rows if row[0] not in newer]
+
+            db.executemany(
+                'INSERT OR REPLACE INTO responses'
+                '(key, status, reason, url, headers, body, created_at, expires_at, codec, endpoint) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows)
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+        return len(rows)
+
+    def touch(self, keys, expires_at):
+        """ these entries are still good, keep them until expires_at """
+        db = self._connect()
+        try:
+            db.executemany('UPDATE responses SET expires_at = ? WHERE key = ?',
+                           [(expires_at, key) for key in keys])
+        finally:
+            db.close()
+
+    def delete(self, key):
+        db = self._connect()
+        try:
+            db.execute('DELETE FROM responses WHERE key = ?', (key,))
+        finally:
+            db.close()
+
+    def prune(self, expired_for=0, now=None, vacuum=False):
+        """
+        remove the entries expired for more than expired_for seconds, return how many
+        with vacuum, the file is shrunk too, but it can take a while
+        """
+        db = self._connect()
+        try:
+            removed = db.execute('DELETE FROM responses WHERE expires_at <= ?',
+                                 ((now or time.time()) - expired_for,)).rowcount
+            if vacuum:
+                db.execute('VACUUM')
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return removed
+        finally:
+            db.close()
+
+    def record_lookups(self, lookups):
+        """ add {endpoint: (hits, misses)} of a run to the totals """
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            for endpoint, (hits, misses) in lookups.items():
+                db.execute('INSERT OR IGNORE INTO lookups(endpoint, hits, misses) VALUES (?, 0, 0)', (endpoint,))
+                db.execute('UPDATE lookups SET hits = hits + ?, misses = misses + ? WHERE endpoint = ?',
+                           (hits, misses, endpoint))
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def stats_by_endpoint(self, now=None):
+        """ {endpoint: {'entries', 'expired', 'stored_bytes', 'hits', 'misses'}} for all the runs """
+        db = self._connect()
+        try:
+            by_endpoint = collections.defaultdict(lambda: dict.fromkeys(
+                ('entries', 'expired', 'stored_bytes', 'hits', 'misses'), 0))
+
+            for endpoint, entries, expired, stored_bytes in db.execute(
+                    'SELECT coalesce(endpoint, ?), count(*), sum(expires_at <= ?), coalesce(sum(length(body)), 0) '
+                    'FROM responses GROUP BY 1', ('other', now or time.time())):
+                by_endpoint[endpoint].update(entries=entries, expired=expired, stored_bytes=stored_bytes)
+
+            for endpoint, hits, misses in db.execute('SELECT endpoint, hits, misses FROM lookups'):
+                by_endpoint[endpoint].update(hits=hits, misses=misses)
+
+            return dict(by_endpoint)
+        finally:
+            db.close()
+
+    def stats(self):
+        """ what the cache holds, and what compressing it gives """
+        db = self._connect()
+        try:
+            entries, stored_bytes = db.execute(
+                'SELECT count(*), coalesce(sum(length(body)), 0) FROM responses').fetchone()
+        finally:
+            db.close()
+
+        stats = self.run_stats()
+        stats.update(entries=entries, stored_bytes=stored_bytes)
+        return stats
+
+
+def get_backend(url=CACHE_URL):
+    """ the backend for this cache url, redis://... for a shared one, a SQLite file in DATA_DIR by default """
+    if url and url.startswith('redis://'):
+        from .redis_backend import RedisBackend
+        return RedisBackend(url)
+    if url:
+        raise ValueError("Unknown cache url %s, only redis:// is supported" % url)
+    return SqliteBackend()
+
+
+def export_bundle(backend, path, include_expired=False):
+    """
+    write the entries of the cache in a portable bundle: gzipped json lines,
+    with the bodies uncompressed and in base64, return how many were written
+    """
+    now = time.time()
+    exported = 0
+    with gzip.open(path, 'wt', encoding='utf-8') as bundle:
+        for key, entry in backend.items():
+            if not include_expired and entry.expires_at <= now:
+                continue
+            line = entry._asdict()
+            line['key'] = key
+            line['body'] = base64.b64encode(entry.body).decode('ascii')
+            bundle.write(json.dumps(line) + '\n')
+            exported += 1
+    return exported
+
+
+def import_bundle(backend, path):
+    """ add the entries of a bundle to the cache, but not over newer ones, return how many were written """
+    imported = 0
+    batch = []
+    with gzip.open(path, 'rt', encoding='utf-8') as bundle:
+        for line in bundle:
+            line = json.loads(line)
+            line['body'] = base64.b64decode(line['body'])
+            batch.append((line.pop('key'), CacheEntry(**line)))
+
+            if len(batch) >= BUNDLE_IMPORT_BATCH:
+                imported += backend.set_many(batch, only_newer=True)
+                batch = []
+
+    if batch:
+        imported += backend.set_many(batch, only_newer=True)
+    return imported
+
+
+def response_from_entry(entry):
+    """ rebuild a requests.Response from what was cached """
+    response = requests.Response()
+    response.status_code = entry.status
+    response.reason = entry.reason
+    response.url = entry.url
+    response.headers = CaseInsensitiveDict(entry.headers)
+    response._content = entry.body
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.from_cache = True
+    return response
+
+
+class ResponseCache(Middleware):
+    """
+    Cache the OPS responses on disk, or in a shared backend, see get_backend,
+    for ttl seconds, keyed like the epo_ops Dogpile middleware, but durable
+    between runs and safe to use from many threads and processes at once
+    Calls about one publication are keyed on its identity, see publication_key,
+    so the Epodoc and the Docdb of the same document share their entry:
+    - a family is the same whatever the kind, so its key has none
+    - the biblio of an Epodoc with only one document is kept under its Docdb too
+    Entries of the stale_endpoints expired for less than max_stale are still served, and done again
+    in background, one at a time, with revalidate_with (a func(url, data, **kwargs)
+    that goes through the whole client, so the throttle and the budget apply)
+    Searches have their own, shorter, search_ttl
+    When offline, everything is served from the cache, whatever its age, and
+    a miss raises a NotInCacheError instead of going to OPS
+    """
+    thread_safe = True
+
+    def __init__(self, backend=None, ttl=DEFAULT_CACHE_TTL, http_status_codes=CACHEABLE_STATUS_CODES,
+                 max_stale=DEFAULT_MAX_STALE, stale_endpoints=STALE_SERVED_ENDPOINTS, search_ttl=SEARCH_CACHE_TTL):
+        self.backend = backend or get_backend()
+        self.ttl = ttl
+        self.search_ttl = search_ttl
+        self.http_status_codes = http_status_codes
+        self.max_stale = max_stale
+        self.stale_endpoints = stale_endpoints
+        self.revalidate_with = None
+        self.offline = False
+        self.offline_misses = []  # urls we did not have when offline
+        self.lookups = collections.defaultdict(lambda: [0, 0])  # endpoint -> [hits, misses] not saved yet
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.revalidations = 0
+        self.unchanged = 0
+        self._lock = threading.Lock()
+
+        self._local = threading.local()  # is this thread revalidating
+        self._pending = set()
+        self._queue = queue.Queue(maxsize=MAX_PENDING_REVALIDATIONS)
+        self._worker = None
+
+    def save_stats(self):
+        """ add the hits and misses of the run to the ones of the previous runs """
+        with self._lock:
+            lookups, self.lookups = self.lookups, collections.defaultdict(lambda: [0, 0])
+        if lookups:
+            self.backend.record_lookups(lookups)
+
+    def close(self):
+        """ stop refreshing, what is not refreshed yet will be the next run """
+        self.save_stats()
+        self.backend.close()
+        with self._lock:
+            if self._worker:
+                self._pending.clear()
+                while not self._queue.empty():
+                    self._queue.get_nowait()
+                self._queue.put(None)
+                self._worker = None
+
+    def _revalidate_later(self, key, url, data, kwargs):
+        with self._lock:
+            if key in self._pending:
+                return
+
+            try:
+                self._queue.put_nowait((key, url, data, kwargs))
+            except queue.Full:
+                return
+            self._pending.add(key)
+
+            if not self._worker:
+                self._worker = threading.Thread(target=self._revalidate_forever, daemon=True)
+                self._worker.start()
+
+    def _revalidate_forever(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            key, url, data, kwargs = item
+            self._local.revalidating = True
+            try:
+                if self.backend.get(key):
+                    # already fresh again, by a previous refresh or another process
+                    continue
+                self.revalidate_with(url, data, **kwargs)
+                with self._lock:
+                    self.revalidations += 1
+            except Exception as e:
+                logger_epo.debug("Could not refresh %s, keeping the stale entry : %s" % (key, e))
+            finally:
+                self._local.revalidating = False
+                with self._lock:
+                    self._pending.discard(key)
+
+    def summary(self):
+        stats = self.backend.stats()
+        lines = [
+            "Cache: %s hits, %s misses in this run" % (self.hits, self.misses),
+            "Cache: %s entries for %s bytes" % (stats['entries'], stats['stored_bytes']),
+        ]
+        if stats['run_compression_ratio']:
+            lines.append("Cache: responses of this run compressed %.1f times" % stats['run_compression_ratio'])
+        if stats['run_decodes']:
+            lines.append("Cache: %.2f ms to decode a response, on average" % (
+                stats['run_decode_time'] * 1000 / stats['run_decodes']))
+        if self.offline_misses:
+            lines.append("Cache: %s calls were not in the cache, and not done as we are offline" % (
+                len(self.offline_misses)))
+        if self.stale_hits:
+            lines.append("Cache: %s stale entries served, %s refreshed, %s of them were unchanged" % (
+                self.stale_hits, self.revalidations, self.unchanged))
+        return "\n".join(lines)
+
+    def _publication_key(self, url, data):
+        matched = re.match(PUBLICATION_URL_REGEX, str(url))
+        if not matched or not isinstance(data, str):
+            return None
+
+        publication = publication_key(matched.group('input_format'), data,
+                                      with_kind=matched.group('service') != 'family')
+        if publication:
+            return '|'.join([
+                'epo-ops-%s' % epo_ops.__version__,
+                matched.group('prefix') + (matched.group('rest') or ''),
+                publication,
+            ])
+
+    def generate_key(self, url, data, **kwargs):
+        key = self._publication_key(url, data)
+        if key:
+            return key
+
+        key = ['epo-ops-%s' % epo_ops.__version__, str(url), str(data)]
+
+        range_key = kwarg_range_header_handler(**kwargs)
+        if range_key:
+            key.append(range_key)
+
+        return '|'.join(key)
+
+    def _ttl(self, url):
+        """ how long the response of this call is served """
+        return self.search_ttl if endpoint_for_url(url) == 'published-data/search' else self.ttl
+
+    def touch(self, keys):
+        """ a refresh has found these entries unchanged, they are good for another ttl """
+        self.backend.touch(keys, time.time() + self.ttl)
+        with self._lock:
+            self.unchanged += 1
+
+    def _docdb_alias(self, url, content):
+        """ the key of the Docdb of this Epodoc biblio response, if it is about one document only """
+        matched = re.match(PUBLICATION_URL_REGEX, str(url))
+        if not matched or \
+                matched.group('service') != 'published-data' or matched.group('input_format') != 'epodoc':
+            return None
+
+        exchange_document = _single_exchange_document(content)
+        if not exchange_document:
+            return None
+
+        api_input = '(%s).(%s).(%s)' % (exchange_document.get('@country'),
+                                        exchange_document.get('@doc-number'),
+                                        exchange_document.get('@kind'))
+        return self._publication_key(
+            '%s/docdb%s' % (matched.group('prefix'), matched.group('rest') or ''), api_input)
+
+    def _set(self, key, url, entry):
+        """ keep the entry, and under the Docdb alias too when it is about a single Epodoc document """
+        self.backend.set(key, entry)
+
+        if entry.status == requests.codes.ok:
+            alias = self._docdb_alias(url, entry.body)
+            if alias and alias != key:
+                self.backend.set(alias, entry)
+
+    def store(self, url, data, status, reason, headers, body):
+        """ keep a response for this call as if it had been done, return its key """
+        key = self.generate_key(url, data)
+        now = time.time()
+        self._set(key, url, CacheEntry(status, reason, url, dict(headers), body, now, now + self._ttl(url)))
+        return key
+
+    def _cached_response(self, key, url, data, kwargs):
+        """ the response we have for this call, if it can be served, queued for a refresh when stale """
+        if self.offline:
+            max_stale = float('inf')
+        elif self.revalidate_with is not None and endpoint_for_url(url) in self.stale_endpoints:
+            max_stale = self.max_stale
+        else:
+            max_stale = 0
+
+        entry = self.backend.get(key, max_stale=max_stale)
+        is_stale = entry is not None and entry.expires_at <= time.time() and not self.offline
+
+        with self._lock:
+            if entry:
+                self.hits += 1
+                self.lookups[endpoint_for_url(url)][0] += 1
+            else:
+                self.misses += 1
+                self.lookups[endpoint_for_url(url)][1] += 1
+            if is_stale:
+                self.stale_hits += 1
+
+        if not entry:
+            return None
+
+        if is_stale:
+            self._revalidate_later(key, url, data, kwargs)
+        return response_from_entry(entry)
+
+    def record_offline_miss(self, url, data):
+        """ a call that is not done, as we are offline and the cache does not have it """
+        logger_epo.debug("Offline, and %s %s is not in the cache" % (url, data))
+        with self._lock:
+            self.offline_misses.append(url)
+
+    @contextlib.contextmanager
+    def fresh(self):
+        """
+        the calls of this thread, within it, go to OPS whatever the cache has,
+        and their responses are kept as usual. Offline, the cache still serves them
+        """
+        self._local.fresh = True
+        try:
+            yield
+        finally:
+            self._local.fresh = False
+
+    def lookup(self, url, data, **kwargs):
+        """
+        the response of this call if the cache can serve it, else None,
+        to know what is left to ask OPS, like the inputs of a bulk call
+        """
+        return self._cached_response(self.generate_key(url, data, **kwargs), url, data, kwargs)
+
+    def process_request(self, env, url, data, **kwargs):
+        key = self.generate_key(url, data, **kwargs)
+        env['cache-key'] = key
+        env['cache-url'] = url
+
+        if getattr(self._local, 'revalidating', False) or (getattr(self._local, 'fresh', False) and not self.offline):
+            # we are here to replace the entry
+            return url, data, kwargs
+
+        response = self._cached_response(key, url, data, kwargs)
+
+        if response is not None:
+            env['from-cache'] = True
+            env['response'] = response
+        elif self.offline:
+            self.record_offline_miss(url, data)
+            response = requests.Response()
+            response.status_code = requests.codes.gateway_timeout  # like an HTTP cache asked for only-if-cached
+            response.url = url
+            raise NotInCacheError("Offline, and not in the cache : %s %s" % (url, data), response=response)
+        return url, data, kwargs
+
+    def process_response(self, env, response):
+        if not env['from-cache'] and response.status_code in self.http_status_codes:
+            now = time.time()
+            entry = CacheEntry(
+                response.status_code,
+                response.reason,
+                response.url,
+                dict(response.headers),
+                response.content,
+                now,
+                now + self._ttl(env.get('cache-url')),
+            )
+            self._set(env['cache-key'], env.get('cache-url'), entry)
+            env['is-cached'] = True
+        return response
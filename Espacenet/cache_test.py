@@ -0,0 +1,348 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+from epo_ops.models import Docdb, Epodoc
+
+from .cache import CacheEntry, NotInCacheError, ResponseCache, SqliteBackend, publication_key, \
+    export_bundle, import_bundle
+from .retry import RetryPolicy
+
+
+def ops_response(content, status_code=200):
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = 'OK'
+    response.url = 'https://ops.epo.org/3.2/rest-services/published-data/publication/epodoc/EP2936195/biblio'
+    response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    response._content = content
+    return response
+
+
+def new_env():
+    return {'cache-key': None, 'from-cache': False, 'is-cached': False, 'response': None}
+
+
+class TestResponseCache(unittest.TestCase):
+    url = 'https://ops.epo.org/3.2/rest-services/published-data/publication/epodoc/biblio'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def cache_once(self, cache, content, status_code=200, **kwargs):
+        env = new_env()
+        cache.process_request(env, self.url, 'EP2936195', **kwargs)
+        cache.process_response(env, ops_response(content, status_code))
+        return env
+
+    def test_should_serve_responses_of_a_previous_run(self):
+        self.cache_once(ResponseCache(SqliteBackend(self.path)), b'{"ops": 1}')
+
+        env = new_env()
+        ResponseCache(SqliteBackend(self.path)).process_request(env, self.url, 'EP2936195')
+
+        self.assertTrue(env['from-cache'])
+        self.assertEqual(env['response'].status_code, 200)
+        self.assertEqual(env['response'].json(), {"ops": 1})
+        self.assertEqual(env['response'].headers['content-type'], 'application/json; charset=utf-8')
+
+    def test_should_expire_entries(self):
+        cache = ResponseCache(SqliteBackend(self.path), ttl=-1)
+        self.cache_once(cache, b'{"ops": 1}')
+
+        env = new_env()
+        cache.process_request(env, self.url, 'EP2936195')
+        self.assertFalse(env['from-cache'])
+
+    def test_should_not_cache_errors_nor_mix_ranges(self):
+        cache = ResponseCache(SqliteBackend(self.path))
+        self.assertFalse(self.cache_once(cache, b'busy', 503)['is-cached'])
+        self.cache_once(cache, b'first page', headers={'X-OPS-Range': '1-100'})
+
+        env = new_env()
+        cache.process_request(env, self.url, 'EP2936195', headers={'X-OPS-Range': '101-200'})
+        self.assertFalse(env['from-cache'])
+
+    def test_should_be_usable_from_many_threads(self):
+        cache = ResponseCache(SqliteBackend(self.path))
+        errors = []
+
+        def write_and_read(i):
+            try:
+                env = new_env()
+                cache.process_request(env, self.url, 'EP%s' % i)
+                cache.process_response(env, ops_response(b'%d' % i))
+                env = new_env()
+                cache.process_request(env, self.url, 'EP%s' % i)
+                self.assertEqual(env['response'].content, b'%d' % i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write_and_read, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+
+class TestCompressedBackend(unittest.TestCase):
+    body = b'{"@document-id-type": "docdb", "country": {"$": "EP"}}' * 100
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_should_store_bodies_compressed(self):
+        backend = SqliteBackend(self.path)
+        backend.set('key', CacheEntry(200, 'OK', 'url', {}, self.body, 0, time.time() + 60))
+
+        self.assertEqual(backend.get('key').body, self.body)
+
+        stats = backend.stats()
+        self.assertLess(stats['stored_bytes'], len(self.body) / 10)
+        self.assertGreater(stats['run_compression_ratio'], 10)
+        self.assertEqual(stats['run_decodes'], 1)
+
+    def test_should_read_a_cache_from_before_the_compression(self):
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE responses(key text primary key, status integer, reason text, url text, '
+                   'headers text, body blob, created_at real, expires_at real)')
+        db.execute('INSERT INTO responses VALUES (?, 200, ?, ?, ?, ?, 0, ?)',
+                   ('key', 'OK', 'url', '{}', self.body, time.time() + 60))
+        db.commit()
+        db.close()
+
+        self.assertEqual(SqliteBackend(self.path).get('key').body, self.body)
+
+
+class TestCanonicalKeys(unittest.TestCase):
+    ops_url = 'https://ops.epo.org/3.2/rest-services'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(SqliteBackend(os.path.join(self.tmp_dir.name, 'cache.db')))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def key(self, service, input):
+        url = '%s/%s/publication/%s/biblio' % (self.ops_url, service, input.__class__.__name__.lower())
+        return self.cache.generate_key(url, input.as_api_input())
+
+    def test_should_find_the_identity_of_a_publication(self):
+        self.assertEqual(publication_key('epodoc', Epodoc('EP2936195').as_api_input()), 'EP2936195')
+        self.assertEqual(publication_key('epodoc', Epodoc('ep 2936195').as_api_input()), 'EP2936195')
+        self.assertEqual(publication_key('docdb', Docdb('2936195', 'EP', 'B1').as_api_input()), 'EP2936195.B1')
+        self.assertEqual(publication_key('docdb', Docdb('2936195', 'EP', 'B1').as_api_input(), with_kind=False),
+                         'EP2936195')
+        # not sure about these
+        self.assertIsNone(publication_key('epodoc', '(EP2936195)\n(EP2936196)'))
+        self.assertIsNone(publication_key('docdb', Docdb('2936195', 'EP', 'B1', '20150101').as_api_input()))
+
+    def test_should_share_the_family_between_input_formats(self):
+        self.assertEqual(self.key('family', Epodoc('EP2936195')),
+                         self.key('family', Docdb('2936195', 'EP', 'B1')))
+        self.assertNotEqual(self.key('published-data', Epodoc('EP2936195')),
+                            self.key('published-data', Docdb('2936195', 'EP', 'B1')))
+
+    def fetch_epodoc(self, documents):
+        url = '%s/published-data/publication/epodoc/biblio' % self.ops_url
+        env = new_env()
+        self.cache.process_request(env, url, Epodoc('EP2936195').as_api_input())
+        content = {'ops:world-patent-data': {'exchange-documents': [
+            {'exchange-document': {'@country': 'EP', '@doc-number': '2936195', '@kind': kind}}
+            for kind in documents
+        ]}}
+        self.cache.process_response(env, ops_response(json.dumps(content).encode('utf-8')))
+
+    def is_docdb_cached(self, kind):
+        url = '%s/published-data/publication/docdb/biblio' % self.ops_url
+        env = new_env()
+        self.cache.process_request(env, url, Docdb('2936195', 'EP', kind).as_api_input())
+        return env['from-cache']
+
+    def test_should_serve_the_docdb_of_a_single_document_epodoc(self):
+        self.fetch_epodoc(['B1'])
+
+        self.assertTrue(self.is_docdb_cached('B1'))
+        self.assertFalse(self.is_docdb_cached('A1'))
+
+    def test_should_not_alias_an_epodoc_with_many_documents(self):
+        self.fetch_epodoc(['A1', 'B1'])
+
+        self.assertFalse(self.is_docdb_cached('A1'))
+        self.assertFalse(self.is_docdb_cached('B1'))
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    url = TestResponseCache.url
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backend = SqliteBackend(os.path.join(self.tmp_dir.name, 'cache.db'))
+        self.refreshed = threading.Event()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def expired_since(self, seconds):
+        cache = ResponseCache(self.backend)
+        env = new_env()
+        cache.process_request(env, self.url, 'EP2936195')
+        self.backend.set(env['cache-key'], CacheEntry(200, 'OK', self.url, {}, b'"stale"', 0, time.time() - seconds))
+
+    def call_ops_again(self, cache, url, data, **kwargs):
+        """ what the client does, through all the middlewares """
+        env = new_env()
+        cache.process_request(env, url, data, **kwargs)
+        self.assertFalse(env['from-cache'])
+        cache.process_response(env, ops_response(b'"fresh"'))
+        self.refreshed.set()
+
+    def test_should_serve_stale_and_refresh_in_background(self):
+        self.expired_since(60)
+        cache = ResponseCache(self.backend)
+        cache.revalidate_with = lambda url, data, **kwargs: self.call_ops_again(cache, url, data, **kwargs)
+
+        env = new_env()
+        cache.process_request(env, self.url, 'EP2936195')
+        self.assertEqual(env['response'].json(), 'stale')
+
+        self.assertTrue(self.refreshed.wait(5))
+        worker = cache._worker
+        cache.close()
+        worker.join(5)
+
+        env = new_env()
+        cache.process_request(env, self.url, 'EP2936195')
+        self.assertEqual(env['response'].json(), 'fresh')
+        self.assertEqual((cache.stale_hits, cache.revalidations), (1, 1))
+
+    def test_should_not_serve_too_stale(self):
+        self.expired_since(120)
+        cache = ResponseCache(self.backend, max_stale=60)
+        cache.revalidate_with = lambda url, data, **kwargs: self.call_ops_again(cache, url, data, **kwargs)
+
+        env = new_env()
+        cache.process_request(env, self.url, 'EP2936195')
+        self.assertFalse(env['from-cache'])
+
+    def test_should_not_serve_stale_without_a_way_to_refresh(self):
+        self.expired_since(60)
+
+        env = new_env()
+        ResponseCache(self.backend).process_request(env, self.url, 'EP2936195')
+        self.assertFalse(env['from-cache'])
+
+    def test_should_not_serve_a_stale_search(self):
+        search_url = 'https://ops.epo.org/3.2/rest-services/published-data/search/biblio'
+        cache = ResponseCache(self.backend)
+        cache.revalidate_with = lambda url, data, **kwargs: self.call_ops_again(cache, url, data, **kwargs)
+
+        env = new_env()
+        cache.process_request(env, search_url, {'q': 'pa=epfl'})
+        cache.process_response(env, ops_response(b'"results"'))
+        entry = self.backend.get(env['cache-key'])
+        self.assertLessEqual(entry.expires_at - entry.created_at, cache.search_ttl)
+
+        self.backend.set(env['cache-key'], entry._replace(expires_at=time.time() - 60))
+        env = new_env()
+        cache.process_request(env, search_url, {'q': 'pa=epfl'})
+        self.assertFalse(env['from-cache'])
+        self.assertEqual(cache.stale_hits, 0)
+
+
+class TestOffline(unittest.TestCase):
+    url = TestResponseCache.url
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(SqliteBackend(os.path.join(self.tmp_dir.name, 'cache.db')))
+        self.cache.offline = True
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_should_fail_fast_on_a_miss(self):
+        with self.assertRaises(NotInCacheError) as raised:
+            self.cache.process_request(new_env(), self.url, 'EP2936195')
+
+        self.assertFalse(RetryPolicy().is_retryable(raised.exception))
+        self.assertEqual(self.cache.offline_misses, [self.url])
+
+    def test_should_serve_whatever_the_age(self):
+        key = self.cache.generate_key(self.url, 'EP2936195')
+        self.cache.backend.set(key, CacheEntry(200, 'OK', self.url, {}, b'"old"', 0, 1))
+
+        env = new_env()
+        self.cache.process_request(env, self.url, 'EP2936195')
+        self.assertEqual(env['response'].json(), 'old')
+        self.assertEqual(self.cache.stale_hits, 0)
+
+
+class TestCacheManagement(unittest.TestCase):
+    published_data_url = 'https://ops.epo.org/3.2/rest-services/published-data/publication/epodoc/biblio'
+    family_url = 'https://ops.epo.org/3.2/rest-services/family/publication/epodoc/biblio'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backend = SqliteBackend(os.path.join(self.tmp_dir.name, 'cache.db'))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def entry(self, url, body, created_at=0, expires_in=60):
+        return CacheEntry(200, 'OK', url, {'Content-Type': 'application/json'}, body,
+                          created_at, time.time() + expires_in)
+
+    def test_should_give_stats_by_endpoint(self):
+        self.backend.set('a', self.entry(self.published_data_url, b'a'))
+        self.backend.set('b', self.entry(self.family_url, b'b', expires_in=-60))
+
+        cache = ResponseCache(self.backend)
+        cache.process_request(new_env(), self.published_data_url, 'EP1')
+        cache.save_stats()
+
+        stats = self.backend.stats_by_endpoint()
+        self.assertEqual(stats['published-data']['entries'], 1)
+        self.assertEqual(stats['published-data']['misses'], 1)
+        self.assertEqual(stats['family']['expired'], 1)
+
+    def test_should_prune_expired_entries(self):
+        self.backend.set('fresh', self.entry(self.published_data_url, b'a'))
+        self.backend.set('expired', self.entry(self.published_data_url, b'b', expires_in=-60))
+        self.backend.set('long expired', self.entry(self.published_data_url, b'c', expires_in=-3600))
+
+        self.assertEqual(self.backend.prune(expired_for=600), 1)
+        self.assertEqual(self.backend.prune(vacuum=True), 1)
+        self.assertEqual([key for key, _ in self.backend.items()], ['fresh'])
+
+    def test_should_move_the_cache_in_a_bundle(self):
+        self.backend.set('a', self.entry(self.published_data_url, b'\x00binary', created_at=10))
+        self.backend.set('b', self.entry(self.family_url, b'newer here', created_at=10))
+        self.backend.set('expired', self.entry(self.family_url, b'old', expires_in=-60))
+        bundle_path = os.path.join(self.tmp_dir.name, 'cache.jsonl.gz')
+        self.assertEqual(export_bundle(self.backend, bundle_path), 2)
+
+        other_backend = SqliteBackend(os.path.join(self.tmp_dir.name, 'other.db'))
+        other_backend.set('b', self.entry(self.family_url, b'newer there', created_at=20))
+        self.assertEqual(import_bundle(other_backend, bundle_path), 1)
+
+        self.assertEqual(other_backend.get('a').body, b'\x00binary')
+        self.assertEqual(other_backend.get('a').headers, {'Content-Type': 'application/json'})
+        self.assertEqual(other_backend.get('b').body, b'newer there')
+        self.assertIsNone(other_backend.get('expired', max_stale=3600))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import sys
+import threading
+
+# the default ceiling of the parsed results kept in memory
+DEFAULT_MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def estimate_size(value, _seen=None):
+    """ a rough size in bytes of a parsed result (json, patents, families...) """
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        size += sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(v, _seen) for v in value)
+    elif hasattr(value, '__dict__'):
+        size += estimate_size(vars(value), _seen)
+
+    return size
+
+
+class MemoryCache(object):
+    """
+    A least recently used cache of parsed results, bounded by their
+    estimated size. It sits in front of the disk cache, so the lookups
+    a run does again and again don't even parse the json twice
+    """
+    def __init__(self, max_bytes=DEFAULT_MEMORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # key -> (value, size), oldest first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ the value of this key, None if we don't have it """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            # would evict everything else, and be evicted by the next put
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_call(self, key, func, *args, **kwargs):
+        """ the value of this key, computed by func and kept if we don't have it """
+        value = self.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            self.put(key, value)
+        return value
+
+    def summary(self):
+        return "Memory cache: %s hits, %s misses, %s evictions, %s entries for %s bytes (max %s)" % (
+            self.hits, self.misses, self.evictions, len(self._entries), self.current_bytes, self.max_bytes)
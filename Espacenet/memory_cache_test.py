@@ -0,0 +1,40 @@
+import unittest
+
+from .memory_cache import MemoryCache, estimate_size
+
+
+class TestMemoryCache(unittest.TestCase):
+    def test_should_count_hits_and_misses(self):
+        memory_cache = MemoryCache()
+        calls = []
+
+        def fetch(value):
+            calls.append(value)
+            return {'json': value}
+
+        self.assertEqual(memory_cache.get_or_call('EP2936195', fetch, 'EP2936195'), {'json': 'EP2936195'})
+        self.assertEqual(memory_cache.get_or_call('EP2936195', fetch, 'EP2936195'), {'json': 'EP2936195'})
+
+        self.assertEqual(calls, ['EP2936195'])
+        self.assertEqual((memory_cache.hits, memory_cache.misses), (1, 1))
+
+    def test_should_evict_the_least_recently_used(self):
+        value_size = estimate_size(['x' * 1000])
+        memory_cache = MemoryCache(max_bytes=value_size * 2)
+
+        memory_cache.put('first', ['x' * 1000])
+        memory_cache.put('second', ['y' * 1000])
+        memory_cache.get('first')
+        memory_cache.put('third', ['z' * 1000])
+
+        self.assertIsNotNone(memory_cache.get('first'))
+        self.assertIsNone(memory_cache.get('second'))
+        self.assertEqual(memory_cache.evictions, 1)
+        self.assertLessEqual(memory_cache.current_bytes, memory_cache.max_bytes)
+
+    def test_should_not_keep_what_is_bigger_than_the_ceiling(self):
+        memory_cache = MemoryCache(max_bytes=100)
+        memory_cache.put('big', 'x' * 1000)
+
+        self.assertIsNone(memory_cache.get('big'))
+        self.assertEqual(memory_cache.current_bytes, 0)
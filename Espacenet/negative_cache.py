@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.exceptions import HTTPError
+
+from .settings import data_path
+
+logger_epo = logging.getLogger('EPO')
+
+# how long we trust OPS to refuse an input again
+DEFAULT_NEGATIVE_TTL = 60 * 60 * 24 * 7  # one week
+
+# statuses that say the input is bad, not that OPS has a bad moment
+NEGATIVE_STATUS_CODES = (
+    requests.codes.bad,  # 400
+    requests.codes.not_found,  # 404
+)
+
+
+class KnownBadInputError(HTTPError):
+    """ OPS has already refused this input, and we did not ask again """
+
+
+class NegativeCache(object):
+    """
+    Remember the inputs OPS refuses, by endpoint, with the status it gave,
+    so the next runs don't spend a call and a throttle slot on them
+    """
+    def __init__(self, path=None, ttl=DEFAULT_NEGATIVE_TTL):
+        self.path = path or data_path('negative_cache.db')
+        self.ttl = ttl
+        self.hits = []  # (endpoint, input_key, status) short-circuited in this run
+        self._lock = threading.Lock()
+
+        db = self._connect()
+        try:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS negatives(
+                    endpoint text,
+                    input_key text,
+                    status integer,
+                    reason text,
+                    created_at real,
+                    primary key (endpoint, input_key)
+                )""")
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def get(self, endpoint, input_key):
+        """ the (status, reason) OPS gave for this input, if we still trust it """
+        db = self._connect()
+        try:
+            return db.execute(
+                'SELECT status, reason FROM negatives WHERE endpoint = ? AND input_key = ? AND created_at > ?',
+                (endpoint, input_key, time.time() - self.ttl)).fetchone()
+        finally:
+            db.close()
+
+    def add(self, endpoint, input_key, status, reason):
+        logger_epo.debug("Remembering that OPS refuses %s on %s with %s" % (input_key, endpoint, status))
+        db = self._connect()
+        try:
+            db.execute(
+                'INSERT OR REPLACE INTO negatives(endpoint, input_key, status, reason, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (endpoint, input_key, status, reason, time.time()))
+        finally:
+            db.close()
+
+    def check(self, endpoint, input_key):
+        """ raise a KnownBadInputError if OPS has already refused this input """
+        known = self.get(endpoint, input_key)
+        if not known:
+            return
+
+        status, reason = known
+        with self._lock:
+            self.hits.append((endpoint, input_key, status))
+
+        response = requests.Response()
+        response.status_code = status
+        raise KnownBadInputError("Already refused by OPS: %s" % reason, response=response)
+
+    def remember(self, endpoint, input_key, func, *args, **kwargs):
+        """ call func, unless the input is known as bad, and remember it if OPS refuses it """
+        self.check(endpoint, input_key)
+
+        try:
+            return func(*args, **kwargs)
+        except KnownBadInputError:
+            raise
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code in NEGATIVE_STATUS_CODES:
+                self.add(endpoint, input_key, e.response.status_code, str(e))
+            raise
+
+    def report(self):
+        """ what has been short-circuited in this run """
+        lines = ["%s known bad inputs have been skipped without asking OPS" % len(self.hits)]
+        for endpoint, input_key, status in self.hits:
+            lines.append("  %s on %s (status %s)" % (input_key, endpoint, status))
+        return "\n".join(lines)
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+import requests
+from requests.exceptions import HTTPError
+
+from .negative_cache import NegativeCache, KnownBadInputError
+
+
+def refused_by_ops(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    raise HTTPError("refused", response=response)
+
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'negative_cache.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_should_not_ask_twice_for_a_refused_input(self):
+        NegativeCache(self.path).add('patent', 'epodoc:EP0000000', 404, 'not found')
+
+        calls = []
+        next_run = NegativeCache(self.path)
+        with self.assertRaises(KnownBadInputError) as raised:
+            next_run.remember('patent', 'epodoc:EP0000000', calls.append, 'called')
+
+        self.assertEqual(calls, [])
+        self.assertEqual(raised.exception.response.status_code, 404)
+        self.assertEqual(len(next_run.hits), 1)
+        self.assertIn('EP0000000', next_run.report())
+
+    def test_should_remember_only_bad_inputs(self):
+        negative_cache = NegativeCache(self.path)
+
+        for status_code in (404, 503):
+            with self.assertRaises(HTTPError):
+                negative_cache.remember('family', 'epodoc:%s' % status_code, refused_by_ops, status_code)
+
+        self.assertTrue(negative_cache.get('family', 'epodoc:404'))
+        self.assertIsNone(negative_cache.get('family', 'epodoc:503'))
+        # only for the endpoint that refused it
+        self.assertIsNone(negative_cache.get('patent', 'epodoc:404'))
+
+    def test_should_forget_after_ttl(self):
+        negative_cache = NegativeCache(self.path, ttl=-1)
+        negative_cache.add('patent', 'epodoc:EP0000000', 404, 'not found')
+
+        self.assertEqual(negative_cache.remember('patent', 'epodoc:EP0000000', lambda: 'asked'), 'asked')
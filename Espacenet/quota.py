@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+
+from epo_ops.middlewares import Middleware
+
+from .settings import data_path
+
+logger_epo = logging.getLogger('EPO')
+
+# what OPS says we have used in the current fair-use periods, in bytes
+QUOTA_HEADERS = {
+    'hour': 'X-IndividualQuotaPerHour-Used',
+    'week': 'X-RegisteredQuotaPerWeek-Used',
+}
+
+
+def _periods(timestamp):
+    """ the hour and week a call belongs to, as keys """
+    moment = datetime.datetime.utcfromtimestamp(timestamp)
+    year, week, _ = moment.isocalendar()
+    return (
+        moment.strftime('hour %Y-%m-%d %H'),
+        'week %s-W%02d' % (year, week),
+    )
+
+
+class QuotaAccounting(Middleware):
+    """
+    Count the OPS calls (cache hits are free) and the bytes they return.
+    The totals by hour and by week are kept in a SQLite file, for all runs,
+    along the last quota usage OPS has reported.
+    A budget can be set for the run, see budget_exceeded
+    """
+    thread_safe = True
+
+    def __init__(self, path=None):
+        self.path = path or data_path('quota.db')
+        self._lock = threading.Lock()
+
+        self.run_bytes = 0
+        self.run_requests = 0
+        self.max_bytes = None
+        self.max_requests = None
+        self.reported = {}  # period -> bytes used, as said by OPS
+
+        db = self._connect()
+        try:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS usage(
+                    period text primary key,
+                    bytes integer,
+                    requests integer
+                )""")
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def set_budget(self, max_bytes=None, max_requests=None):
+        """ start counting the run from now, with these limits (None for no limit) """
+        with self._lock:
+            self.run_bytes = 0
+            self.run_requests = 0
+            self.max_bytes = max_bytes
+            self.max_requests = max_requests
+
+    @property
+    def budget_exceeded(self):
+        return bool(
+            (self.max_bytes is not None and self.run_bytes >= self.max_bytes) or
+            (self.max_requests is not None and self.run_requests >= self.max_requests)
+        )
+
+    def record(self, size, headers):
+        with self._lock:
+            self.run_bytes += size
+            self.run_requests += 1
+
+            for period, header in QUOTA_HEADERS.items():
+                if header in headers:
+                    self.reported[period] = int(headers[header])
+
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            for period in _periods(time.time()):
+                db.execute('INSERT OR IGNORE INTO usage(period, bytes, requests) VALUES (?, 0, 0)', (period,))
+                db.execute('UPDATE usage SET bytes = bytes + ?, requests = requests + 1 WHERE period = ?',
+                           (size, period))
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def usage(self, timestamp=None):
+        """ the totals of the hour and the week, as {period: (bytes, requests)} """
+        db = self._connect()
+        try:
+            totals = {}
+            for period in _periods(timestamp or time.time()):
+                row = db.execute('SELECT bytes, requests FROM usage WHERE period = ?', (period,)).fetchone()
+                totals[period] = row or (0, 0)
+            return totals
+        finally:
+            db.close()
+
+    def summary(self):
+        lines = ["This run used %s bytes in %s OPS calls" % (self.run_bytes, self.run_requests)]
+        for period, (size, requests) in sorted(self.usage().items()):
+            lines.append("Total for %s: %s bytes in %s OPS calls" % (period, size, requests))
+        for period, size in sorted(self.reported.items()):
+            lines.append("OPS reports %s bytes used in its %s quota" % (size, period))
+        return "\n".join(lines)
+
+    def process_request(self, env, url, data, **kwargs):
+        return url, data, kwargs
+
+    def process_response(self, env, response):
+        if not env['from-cache']:
+            self.record(len(response.content), response.headers)
+        return response
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+from .quota import QuotaAccounting
+
+
+class FakeResponse(object):
+    def __init__(self, content, headers=None):
+        self.content = content
+        self.headers = headers or {}
+
+
+class TestQuotaAccounting(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'quota.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_should_count_only_calls_to_ops(self):
+        quota = QuotaAccounting(self.path)
+        quota.process_response({'from-cache': False}, FakeResponse(b'x' * 100))
+        quota.process_response({'from-cache': True}, FakeResponse(b'x' * 100))
+
+        self.assertEqual(quota.run_bytes, 100)
+        self.assertEqual(quota.run_requests, 1)
+
+    def test_should_keep_totals_between_runs(self):
+        QuotaAccounting(self.path).record(100, {})
+        next_run = QuotaAccounting(self.path)
+        next_run.record(50, {})
+
+        for size, requests in next_run.usage().values():
+            self.assertEqual(size, 150)
+            self.assertEqual(requests, 2)
+        self.assertEqual(next_run.run_bytes, 50)
+
+    def test_should_read_quota_used_from_ops(self):
+        quota = QuotaAccounting(self.path)
+        quota.record(10, {'X-IndividualQuotaPerHour-Used': '1234',
+                          'X-RegisteredQuotaPerWeek-Used': '56789'})
+
+        self.assertEqual(quota.reported, {'hour': 1234, 'week': 56789})
+        self.assertIn('56789', quota.summary())
+
+    def test_should_say_when_budget_is_spent(self):
+        quota = QuotaAccounting(self.path)
+        self.assertFalse(quota.budget_exceeded)
+
+        quota.set_budget(max_requests=2)
+        quota.record(10, {})
+        self.assertFalse(quota.budget_exceeded)
+        quota.record(10, {})
+        self.assertTrue(quota.budget_exceeded)
+
+        quota.set_budget(max_bytes=15)
+        quota.record(10, {})
+        self.assertFalse(quota.budget_exceeded)
+        quota.record(10, {})
+        self.assertTrue(quota.budget_exceeded)
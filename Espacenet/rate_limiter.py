@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import sqlite3
+import time
+
+from .settings import data_path
+
+logger_epo = logging.getLogger('EPO')
+
+# allowance used for a service until OPS tells us its own
+DEFAULT_CALLS_PER_MINUTE = 60
+
+# how many seconds of allowance can be spent at once
+BURST_SECONDS = 2
+
+
+class SharedRateLimiter(object):
+    """
+    A token bucket by OPS service, kept in a SQLite file, so all the
+    processes of this host share the same allowance and never overshoot it
+    together. Every process only has to learn the allowance (set_limit),
+    and ask before each call (acquire).
+    """
+    def __init__(self, path=None):
+        self.path = path or data_path('rate_limiter.db')
+
+        db = self._connect()
+        try:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS buckets(
+                    service text primary key,
+                    tokens real,
+                    rate real,
+                    updated_at real,
+                    blocked_until real
+                )""")
+        finally:
+            db.close()
+
+    def _connect(self):
+        # autocommit mode, we open the transactions ourselves
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def _capacity(self, rate):
+        return max(1., rate * BURST_SECONDS)
+
+    def _take(self, service):
+        """ take a token if there is one, return how long to wait otherwise """
+        db = self._connect()
+        try:
+            # lock the database for writing, so only one process refill at a time
+            db.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = db.execute(
+                'SELECT tokens, rate, updated_at, blocked_until FROM buckets WHERE service = ?',
+                (service,)).fetchone()
+
+            if row:
+                tokens, rate, updated_at, blocked_until = row
+            else:
+                rate = DEFAULT_CALLS_PER_MINUTE / 60.
+                tokens, updated_at, blocked_until = self._capacity(rate), now, 0.
+
+            if blocked_until > now:
+                db.execute('ROLLBACK')
+                return blocked_until - now
+
+            tokens = min(self._capacity(rate), tokens + (now - updated_at) * rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+
+            db.execute(
+                'INSERT OR REPLACE INTO buckets(service, tokens, rate, updated_at, blocked_until) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (service, tokens, rate, now, blocked_until))
+            db.execute('COMMIT')
+            return wait
+        finally:
+            db.close()
+
+    def acquire(self, service):
+        """ wait until this host can do one more call to this service """
+        while True:
+            wait = self._take(service)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def set_limit(self, service, calls_per_minute):
+        """ OPS told us the allowance of this service """
+        rate = calls_per_minute / 60.
+        db = self._connect()
+        try:
+            db.execute(
+                'INSERT OR IGNORE INTO buckets(service, tokens, rate, updated_at, blocked_until) '
+                'VALUES (?, ?, ?, ?, 0)',
+                (service, self._capacity(rate), rate, time.time()))
+            db.execute('UPDATE buckets SET rate = ? WHERE service = ? AND rate != ?',
+                       (rate, service, rate))
+        finally:
+            db.close()
+
+    def block(self, service, seconds):
+        """ nobody on this host calls this service for some seconds """
+        db = self._connect()
+        try:
+            db.execute(
+                'INSERT OR IGNORE INTO buckets(service, tokens, rate, updated_at, blocked_until) '
+                'VALUES (?, 0, ?, ?, 0)',
+                (service, DEFAULT_CALLS_PER_MINUTE / 60., time.time()))
+            db.execute('UPDATE buckets SET blocked_until = ? WHERE service = ?',
+                       (time.time() + seconds, service))
+        finally:
+            db.close()
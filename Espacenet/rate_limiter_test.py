@@ -0,0 +1,49 @@
+import os
+import tempfile
+import time
+import unittest
+
+from .rate_limiter import SharedRateLimiter, BURST_SECONDS
+
+
+class TestSharedRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'rate_limiter.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_should_share_the_allowance_between_limiters(self):
+        # two limiters on the same file, as two processes would have
+        first_process = SharedRateLimiter(self.path)
+        second_process = SharedRateLimiter(self.path)
+        first_process.set_limit('retrieval', 600)  # 10 by second
+
+        # spend the whole burst from the first one
+        for i in range(10 * BURST_SECONDS):
+            first_process.acquire('retrieval')
+
+        # the second one has to wait for a refill
+        started = time.monotonic()
+        second_process.acquire('retrieval')
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+    def test_should_keep_services_apart(self):
+        limiter = SharedRateLimiter(self.path)
+        limiter.set_limit('search', 60)
+        limiter.set_limit('retrieval', 600)
+
+        for i in range(BURST_SECONDS):
+            limiter.acquire('search')
+
+        started = time.monotonic()
+        limiter.acquire('retrieval')
+        self.assertLess(time.monotonic() - started, 0.05)
+
+    def test_should_block_a_service_for_everybody(self):
+        SharedRateLimiter(self.path).block('search', 0.2)
+
+        started = time.monotonic()
+        SharedRateLimiter(self.path).acquire('search')
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
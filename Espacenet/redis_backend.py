@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import json
+import logging
+import socket
+import threading
+import time
+import urllib.parse
+
+from .cache import CacheBackend, CacheEntry, DEFAULT_MAX_STALE, endpoint_for_url
+
+logger_epo = logging.getLogger('EPO')
+
+DEFAULT_REDIS_PORT = 6379
+SOCKET_TIMEOUT = 30
+
+# every entry is a hash under this prefix, the hits and misses by endpoint under the second,
+# and the entries and stored bytes by endpoint, kept up to date by set and delete, under the last
+KEY_PREFIX = 'epo-ops-cache:'
+LOOKUPS_PREFIX = 'epo-ops-cache-lookups:'
+COUNTS_PREFIX = 'epo-ops-cache-counts:'
+
+# how many keys we ask for at a time when going through the cache
+SCAN_COUNT = 500
+
+
+class RedisError(Exception):
+    """ the server has answered with an error """
+
+
+class RespConnection(object):
+    """ a minimal client of the Redis protocol (RESP), enough for the cache """
+    def __init__(self, host, port, timeout=SOCKET_TIMEOUT):
+        self.socket = socket.create_connection((host, port), timeout)
+        self.reader = self.socket.makefile('rb')
+
+    def close(self):
+        self.reader.close()
+        self.socket.close()
+
+    def _encode(self, args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            elif not isinstance(arg, bytes):
+                arg = repr(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("The Redis server has closed the connection")
+
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            # not raised here, as it can be one of the replies of an EXEC
+            return RedisError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            if int(rest) < 0:
+                return None
+            return self.reader.read(int(rest) + 2)[:-2]
+        if kind == b'*':
+            if int(rest) < 0:
+                return None
+            return [self._read() for _ in range(int(rest))]
+        raise RedisError("Unknown reply from the Redis server: %r" % line)
+
+    def pipeline(self, commands):
+        """ send all the commands at once, and return their replies """
+        self.socket.sendall(b''.join(self._encode(args) for args in commands))
+        replies = [self._read() for _ in commands]
+
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+
+def _hash_to_dict(reply):
+    """ the [field, value, field, value...] of an HGETALL as a dict """
+    return {reply[i].decode('utf-8'): reply[i + 1] for i in range(0, len(reply), 2)}
+
+
+class RedisBackend(CacheBackend):
+    """
+    The cached responses in a Redis server, like redis://host:6379/0,
+    so all the hosts of a run share what any of them has fetched
+    Same entries, compression and keys as SqliteBackend. Redis drops the
+    entries by itself once they can't be served anymore, keep_stale after their ttl
+    """
+    def __init__(self, url, keep_stale=DEFAULT_MAX_STALE):
+        super().__init__()
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or DEFAULT_REDIS_PORT
+        self.password = parsed.password
+        self.db = int(parsed.path.strip('/') or 0)
+        self.keep_stale = keep_stale
+
+        self._local = threading.local()  # one connection by thread
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def close(self):
+        """ close the connections of all the threads """
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = RespConnection(self.host, self.port)
+            if self.password:
+                connection.execute('AUTH', self.password)
+            if self.db:
+                connection.execute('SELECT', self.db)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _pipeline(self, commands):
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                return connection.pipeline(commands)
+            except (OSError, ConnectionError):
+                # the server may have closed an idle connection, try once with a new one
+                self._local.connection = None
+                connection.close()
+                with self._connections_lock:
+                    if connection in self._connections:
+                        self._connections.remove(connection)
+                if attempt:
+                    raise
+
+    def _execute(self, *args):
+        return self._pipeline([args])[0]
+
+    def _scan_batches(self, prefix):
+        """ all the keys that start with prefix, by batch of the SCAN replies """
+        cursor = b'0'
+        while True:
+            cursor, keys = self._execute('SCAN', cursor, 'MATCH', prefix + '*', 'COUNT', SCAN_COUNT)
+            if keys:
+                yield [key.decode('utf-8') for key in keys]
+            if cursor == b'0':
+                return
+
+    def _scan(self, prefix):
+        """ all the keys that start with prefix """
+        for keys in self._scan_batches(prefix):
+            yield from keys
+
+    def _sizes(self, redis_keys):
+        """ the (endpoint, size of the body) of these entries, (None, None) for the ones we don't have """
+        replies = self._pipeline([command for redis_key in redis_keys for command in (
+            ('HGET', redis_key, 'endpoint'),
+            ('HSTRLEN', redis_key, 'body'),
+            ('HEXISTS', redis_key, 'body'),
+        )])
+        sizes = []
+        for i in range(0, len(replies), 3):
+            endpoint, size, has_body = replies[i:i + 3]
+            if has_body:
+                sizes.append((endpoint.decode('utf-8') if endpoint else 'other', size))
+            else:
+                sizes.append((None, None))
+        return sizes
+
+    def _entry_from_hash(self, fields):
+        return CacheEntry(
+            int(fields['status']),
+            fields['reason'].decode('utf-8'),
+            fields['url'].decode('utf-8'),
+            json.loads(fields['headers'].decode('utf-8')),
+            self._decompress(fields['codec'].decode('utf-8'), fields['body']),
+            float(fields['created_at']),
+            float(fields['expires_at']),
+        )
+
+    def get(self, key, now=None, max_stale=0):
+        fields = _hash_to_dict(self._execute('HGETALL', KEY_PREFIX + key))
+        # without a body, it is what is left of an entry that has expired while touched
+        if 'body' in fields and float(fields['expires_at']) > (now or time.time()) - max_stale:
+            return self._entry_from_hash(fields)
+
+    def items(self):
+        for redis_key in self._scan(KEY_PREFIX):
+            fields = _hash_to_dict(self._execute('HGETALL', redis_key))
+            if 'body' in fields:
+                yield redis_key[len(KEY_PREFIX):], self._entry_from_hash(fields)
+
+    def set(self, key, entry):
+        self.set_many([(key, entry)])
+
+    def set_many(self, items, only_newer=False):
+        written = 0
+        for key, entry in items:
+            redis_key = KEY_PREFIX + key
+
+            if only_newer:
+                created_at = self._execute('HGET', redis_key, 'created_at')
+                if created_at is not None and float(created_at) >= entry.created_at:
+                    continue
+
+            codec, body = self._compress(entry.body)
+            endpoint = endpoint_for_url(entry.url)
+            _, replaced_size = self._sizes([redis_key])[0]
+            self._pipeline([
+                ('MULTI',),
+                ('DEL', redis_key),
+                ('HSET', redis_key,
+                 'status', entry.status,
+                 'reason', entry.reason or '',
+                 'url', entry.url or '',
+                 'headers', json.dumps(entry.headers),
+                 'body', body,
+                 'created_at', entry.created_at,
+                 'expires_at', entry.expires_at,
+                 'codec', codec,
+                 'endpoint', endpoint),
+                ('EXPIREAT', redis_key, int(entry.expires_at + self.keep_stale)),
+                ('HINCRBY', COUNTS_PREFIX + endpoint, 'entries', 0 if replaced_size is not None else 1),
+                ('HINCRBY', COUNTS_PREFIX + endpoint, 'stored_bytes', len(body) - (replaced_size or 0)),
+                ('EXEC',),
+            ])
+            written += 1
+        return written
+
+    def touch(self, keys, expires_at):
+        redis_keys = [KEY_PREFIX + key for key in keys]
+        if not redis_keys:
+            return
+
+        # HSET would create a hash for a key we don't have
+        exists = self._pipeline([('EXISTS', redis_key) for redis_key in redis_keys])
+        commands = []
+        for redis_key, found in zip(redis_keys, exists):
+            if found:
+                commands.extend([
+                    ('MULTI',),
+                    ('HSET', redis_key, 'expires_at', expires_at),
+                    ('EXPIREAT', redis_key, int(expires_at + self.keep_stale)),
+                    ('EXEC',),
+                ])
+        if commands:
+            self._pipeline(commands)
+
+    def _delete(self, redis_keys):
+        """ remove these entries, and take them out of the counts of their endpoint """
+        commands = []
+        for redis_key, (endpoint, size) in zip(redis_keys, self._sizes(redis_keys)):
+            commands.append(('MULTI',))
+            commands.append(('DEL', redis_key))
+            if endpoint is not None:
+                commands.append(('HINCRBY', COUNTS_PREFIX + endpoint, 'entries', -1))
+                commands.append(('HINCRBY', COUNTS_PREFIX + endpoint, 'stored_bytes', -size))
+            commands.append(('EXEC',))
+        if not commands:
+            return 0
+        # the reply of each EXEC has the one of its DEL first
+        return sum(reply[0] for reply in self._pipeline(commands) if isinstance(reply, list))
+
+    def delete(self, key):
+        self._delete([KEY_PREFIX + key])
+
+    def prune(self, expired_for=0, now=None, vacuum=False):
+        """ Redis drops what is older than keep_stale by itself, this is for the ones before """
+        limit = (now or time.time()) - expired_for
+        removed = 0
+        for redis_keys in self._scan_batches(KEY_PREFIX):
+            expires_ats = self._pipeline([('HGET', redis_key, 'expires_at') for redis_key in redis_keys])
+            removed += self._delete([redis_key for redis_key, expires_at in zip(redis_keys, expires_ats)
+                                     if expires_at is not None and float(expires_at) <= limit])
+        return removed
+
+    def record_lookups(self, lookups):
+        commands = []
+        for endpoint, (hits, misses) in lookups.items():
+            commands.append(('HINCRBY', LOOKUPS_PREFIX + endpoint, 'hits', hits))
+            commands.append(('HINCRBY', LOOKUPS_PREFIX + endpoint, 'misses', misses))
+        if commands:
+            self._pipeline(commands)
+
+    def stats_by_endpoint(self, now=None):
+        """
+        goes through all the entries, a batch of keys at a time, and sets the counts
+        of stats() right again, as Redis does not tell us about the entries it drops by itself
+        """
+        now = now or time.time()
+        by_endpoint = collections.defaultdict(lambda: dict.fromkeys(
+            ('entries', 'expired', 'stored_bytes', 'hits', 'misses'), 0))
+
+        for redis_keys in self._scan_batches(KEY_PREFIX):
+            replies = self._pipeline([command for redis_key in redis_keys for command in (
+                ('HMGET', redis_key, 'endpoint', 'expires_at'),
+                ('HSTRLEN', redis_key, 'body'),
+            )])
+            for i in range(0, len(replies), 2):
+                (endpoint, expires_at), size = replies[i:i + 2]
+                if expires_at is None:
+                    continue
+                stats = by_endpoint[endpoint.decode('utf-8') if endpoint else 'other']
+                stats['entries'] += 1
+                stats['expired'] += float(expires_at) <= now
+                stats['stored_bytes'] += size
+
+        commands = [('DEL', redis_key) for redis_key in self._scan(COUNTS_PREFIX)]
+        commands.extend(('HSET', COUNTS_PREFIX + endpoint, 'entries', stats['entries'],
+                         'stored_bytes', stats['stored_bytes'])
+                        for endpoint, stats in by_endpoint.items())
+        if commands:
+            self._pipeline([('MULTI',)] + commands + [('EXEC',)])
+
+        lookups_keys = list(self._scan(LOOKUPS_PREFIX))
+        replies = self._pipeline([('HMGET', redis_key, 'hits', 'misses') for redis_key in lookups_keys])
+        for redis_key, (hits, misses) in zip(lookups_keys, replies):
+            by_endpoint[redis_key[len(LOOKUPS_PREFIX):]].update(hits=int(hits or 0), misses=int(misses or 0))
+
+        return dict(by_endpoint)
+
+    def stats(self):
+        """
+        from the counts kept by set and delete, without going through the entries,
+        the ones Redis has dropped by itself are counted until the next stats_by_endpoint
+        """
+        counts_keys = list(self._scan(COUNTS_PREFIX))
+        entries = stored_bytes = 0
+        for endpoint_entries, endpoint_bytes in self._pipeline(
+                [('HMGET', redis_key, 'entries', 'stored_bytes') for redis_key in counts_keys]):
+            entries += int(endpoint_entries or 0)
+            stored_bytes += int(endpoint_bytes or 0)
+
+        stats = self.run_stats()
+        stats.update(entries=entries, stored_bytes=stored_bytes)
+        return stats
@@ -0,0 +1,202 @@
+import fnmatch
+import socketserver
+import threading
+import time
+import unittest
+
+from .cache import CacheEntry, ResponseCache
+from .redis_backend import RedisBackend, RespConnection
+
+
+class StandInRedis(socketserver.ThreadingTCPServer):
+    """ a tiny in-memory server answering the few Redis commands the backend uses """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInRedisHandler)
+        self.hashes = {}
+        self.expire_at = {}
+        self.lock = threading.Lock()
+
+    def run(self, command, args):
+        now = time.time()
+        for key in [key for key, at in self.expire_at.items() if at <= now]:
+            self.hashes.pop(key, None)
+            del self.expire_at[key]
+
+        if command == 'PING':
+            return 'PONG'
+        if command == 'DEL':
+            return sum(self.hashes.pop(key, None) is not None for key in args)
+        if command == 'EXISTS':
+            return int(args[0] in self.hashes)
+        if command == 'HSET':
+            fields = self.hashes.setdefault(args[0], {})
+            for i in range(1, len(args), 2):
+                fields[args[i]] = args[i + 1]
+            return len(args) // 2
+        if command == 'HGET':
+            return self.hashes.get(args[0], {}).get(args[1])
+        if command == 'HMGET':
+            return [self.hashes.get(args[0], {}).get(field) for field in args[1:]]
+        if command == 'HGETALL':
+            return [item for pair in self.hashes.get(args[0], {}).items() for item in pair]
+        if command == 'HEXISTS':
+            return int(args[1] in self.hashes.get(args[0], {}))
+        if command == 'HSTRLEN':
+            return len(self.hashes.get(args[0], {}).get(args[1], b''))
+        if command == 'HINCRBY':
+            fields = self.hashes.setdefault(args[0], {})
+            fields[args[1]] = b'%d' % (int(fields.get(args[1], 0)) + int(args[2]))
+            return int(fields[args[1]])
+        if command == 'EXPIREAT':
+            self.expire_at[args[0]] = int(args[1])
+            return 1
+        if command == 'SCAN':
+            pattern = args[args.index(b'MATCH') + 1]
+            return [b'0', [key for key in self.hashes if fnmatch.fnmatchcase(key, pattern)]]
+        raise ValueError("ERR unknown command %s" % command)
+
+
+class StandInRedisHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def encode(self, reply):
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, str):
+            return b'+%s\r\n' % reply.encode()
+        if isinstance(reply, Exception):
+            return b'-%s\r\n' % str(reply).encode()
+        if isinstance(reply, list):
+            return b'*%d\r\n' % len(reply) + b''.join(self.encode(item) for item in reply)
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+
+    def handle(self):
+        queued = None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command = args[0].decode().upper()
+
+            if command == 'MULTI':
+                queued, reply = [], 'OK'
+            elif command == 'EXEC':
+                with self.server.lock:
+                    reply = [self.server.run(args[0].decode().upper(), args[1:]) for args in queued]
+                queued = None
+            elif queued is not None:
+                queued.append(args)
+                reply = 'QUEUED'
+            else:
+                try:
+                    with self.server.lock:
+                        reply = self.server.run(command, args[1:])
+                except ValueError as e:
+                    reply = e
+            self.wfile.write(self.encode(reply))
+
+
+class TestRedisBackend(unittest.TestCase):
+    url = 'https://ops.epo.org/3.2/rest-services/family/publication/epodoc/biblio'
+
+    def setUp(self):
+        self.server = StandInRedis()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.backend = RedisBackend('redis://127.0.0.1:%s/0' % self.server.server_address[1])
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def entry(self, body, expires_in=60, created_at=0):
+        return CacheEntry(200, 'OK', self.url, {'Content-Type': 'application/json'}, body,
+                          created_at, time.time() + expires_in)
+
+    def test_should_speak_resp(self):
+        connection = RespConnection('127.0.0.1', self.server.server_address[1])
+        self.assertEqual(connection.execute('PING'), 'PONG')
+        self.assertEqual(connection.pipeline([('HSET', 'h', 'f', b'\r\n'), ('HGET', 'h', 'f')]), [1, b'\r\n'])
+        connection.close()
+
+    def test_should_keep_entries_compressed_with_their_ttl(self):
+        body = b'{"ops:family-member": []}' * 100
+        self.backend.set('EP2936195', self.entry(body))
+
+        self.assertEqual(self.backend.get('EP2936195').body, body)
+        self.assertEqual(self.backend.get('EP2936195').headers, {'Content-Type': 'application/json'})
+        self.assertLess(self.server.hashes[b'epo-ops-cache:EP2936195'][b'body'].__len__(), len(body))
+
+        self.backend.set('expired', self.entry(body, expires_in=-60))
+        self.assertIsNone(self.backend.get('expired'))
+        self.assertIsNotNone(self.backend.get('expired', max_stale=3600))
+
+    def test_should_be_shared_by_the_caches_of_many_hosts(self):
+        first_host = ResponseCache(self.backend)
+        second_host = ResponseCache(RedisBackend('redis://127.0.0.1:%s' % self.server.server_address[1]))
+        key = first_host.generate_key(self.url, '(EP2936195)')
+        first_host.backend.set(key, self.entry(b'"family"'))
+
+        env = {'cache-key': None, 'from-cache': False, 'is-cached': False, 'response': None}
+        second_host.process_request(env, self.url, '(EP2936195)')
+        self.assertEqual(env['response'].json(), 'family')
+        second_host.close()
+
+    def test_should_keep_the_stats(self):
+        self.backend.set('a', self.entry(b'a'))
+        self.backend.touch(['a', 'unknown'], time.time() + 3600)
+        self.backend.record_lookups({'family': (3, 1)})
+
+        stats = self.backend.stats_by_endpoint()['family']
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses']), (1, 3, 1))
+        self.assertEqual([key for key, _ in self.backend.items()], ['a'])
+        self.assertEqual(self.backend.set_many([('a', self.entry(b'older', created_at=-1))], only_newer=True), 0)
+
+    def test_should_count_the_entries_without_going_through_them(self):
+        self.backend.set('a', self.entry(b'a' * 100))
+        self.backend.set('b', self.entry(b'b' * 100))
+        self.backend.set('a', self.entry(b'a' * 200))
+        self.backend.delete('b')
+        self.backend.delete('unknown')
+
+        scanned = []
+        scan = self.backend._scan_batches
+        self.backend._scan_batches = lambda prefix: scanned.append(prefix) or scan(prefix)
+        stats = self.backend.stats()
+        self.assertEqual(scanned, ['epo-ops-cache-counts:'])
+        self.assertEqual(stats['entries'], 1)
+
+        by_endpoint = self.backend.stats_by_endpoint()['family']
+        self.assertEqual((stats['entries'], stats['stored_bytes']),
+                         (by_endpoint['entries'], by_endpoint['stored_bytes']))
+
+    def test_should_set_the_counts_right_on_a_full_scan(self):
+        self.backend.set('a', self.entry(b'a'))
+        self.backend.set('b', self.entry(b'b'))
+        # dropped by Redis itself, the counts can't know
+        del self.server.hashes[b'epo-ops-cache:b']
+        self.assertEqual(self.backend.stats()['entries'], 2)
+
+        self.assertEqual(self.backend.stats_by_endpoint()['family']['entries'], 1)
+        self.assertEqual(self.backend.stats()['entries'], 1)
+
+    def test_should_prune_a_batch_at_a_time(self):
+        self.backend.set('old', self.entry(b'old', expires_in=-60))
+        self.backend.set('new', self.entry(b'new'))
+
+        self.assertEqual(self.backend.prune(), 1)
+        self.assertEqual([key for key, _ in self.backend.items()], ['new'])
+        self.assertEqual(self.backend.stats()['entries'], 1)
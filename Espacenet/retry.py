@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import random
+import threading
+import time
+
+import requests
+from epo_ops import exceptions as epo_exceptions
+
+from .cache import NotInCacheError
+
+logger_epo = logging.getLogger('EPO')
+
+# statuses worth a new try: throttled, or OPS having a bad moment
+RETRYABLE_STATUS_CODES = (403, 429, 500, 502, 503, 504)
+
+
+class CircuitBreaker(object):
+    """
+    Count the calls in a row that have failed, after all their retries.
+    When there are too many, OPS is failing broadly, not only on one input,
+    so every call waits for the cooldown before trying again, instead of hammering it
+    """
+    def __init__(self, failure_threshold=5, cooldown=60):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def wait(self):
+        """ pause the caller while the circuit is open """
+        with self._lock:
+            opened_at = self.opened_at
+
+        if opened_at is not None:
+            remaining = opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                logger_epo.warning("Espacenet is failing, pausing for %d seconds..." % remaining)
+                time.sleep(remaining)
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger_epo.info("Espacenet is answering again")
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                # (re)open for a new cooldown
+                if self.opened_at is None:
+                    logger_epo.warning("%s failed calls in a row, opening the circuit" % self.failures)
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy(object):
+    """
+    Try again the calls that failed on a transient error,
+    waiting a random time up to an exponentially growing delay
+    """
+    def __init__(self, max_retries=4, base_delay=1., max_delay=60., breaker=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+
+    def is_retryable(self, exception):
+        if isinstance(exception, (epo_exceptions.IndividualQuotaPerHourExceeded,
+                                  epo_exceptions.RegisteredQuotaPerWeekExceeded)):
+            # no use trying before the quota is renewed
+            return False
+
+        if isinstance(exception, NotInCacheError):
+            # offline, it won't be in the cache the next time either
+            return False
+
+        if isinstance(exception, requests.exceptions.HTTPError):
+            return exception.response is not None and \
+                exception.response.status_code in RETRYABLE_STATUS_CODES
+
+        return isinstance(exception, (requests.exceptions.ConnectionError,
+                                      requests.exceptions.Timeout))
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+
+        while True:
+            self.breaker.wait()
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # OPS has answered, even if it is to say no
+                    if isinstance(e, requests.exceptions.HTTPError):
+                        self.breaker.success()
+                    raise
+
+                if attempt >= self.max_retries:
+                    # only a call that fails on all its attempts counts for the breaker
+                    self.breaker.failure()
+                    raise
+
+                delay = self.delay(attempt)
+                logger_epo.debug("Retrying in %.1f seconds after %s" % (delay, e))
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.success()
+                return result
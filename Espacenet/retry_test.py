@@ -0,0 +1,106 @@
+import time
+import unittest
+
+import requests
+from requests.exceptions import HTTPError
+from epo_ops import exceptions as epo_exceptions
+
+from .retry import RetryPolicy, CircuitBreaker
+
+
+def http_error(status_code, klass=HTTPError):
+    response = requests.Response()
+    response.status_code = status_code
+    return klass("%s error" % status_code, response=response)
+
+
+class FailingCall(object):
+    """ raise the given errors, one by call, then answer """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "answer"
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_should_retry_transient_errors(self):
+        policy = RetryPolicy(base_delay=0.001)
+        call = FailingCall(http_error(503), http_error(403), requests.exceptions.ConnectionError())
+
+        self.assertEqual(policy.call(call), "answer")
+        self.assertEqual(call.calls, 4)
+
+    def test_should_not_retry_bad_inputs(self):
+        policy = RetryPolicy(base_delay=0.001)
+        call = FailingCall(http_error(404))
+
+        self.assertRaises(HTTPError, policy.call, call)
+        self.assertEqual(call.calls, 1)
+
+    def test_should_not_retry_exceeded_quota(self):
+        policy = RetryPolicy(base_delay=0.001)
+        call = FailingCall(http_error(403, epo_exceptions.RegisteredQuotaPerWeekExceeded))
+
+        self.assertRaises(HTTPError, policy.call, call)
+        self.assertEqual(call.calls, 1)
+
+    def test_should_give_up_after_max_retries(self):
+        policy = RetryPolicy(max_retries=2, base_delay=0.001)
+        call = FailingCall(*[http_error(500) for i in range(5)])
+
+        self.assertRaises(HTTPError, policy.call, call)
+        self.assertEqual(call.calls, 3)
+
+    def test_should_grow_delays_with_jitter(self):
+        policy = RetryPolicy(base_delay=1., max_delay=10.)
+        for attempt in range(8):
+            delay = policy.delay(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(10., 2 ** attempt))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_should_open_after_failures_in_a_row(self):
+        breaker = CircuitBreaker(failure_threshold=3, cooldown=0.2)
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        breaker.failure()
+        self.assertFalse(breaker.is_open)
+
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+
+        started = time.monotonic()
+        breaker.wait()
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+        breaker.success()
+        self.assertFalse(breaker.is_open)
+
+    def test_should_pause_calls_while_open(self):
+        breaker = CircuitBreaker(failure_threshold=2, cooldown=0.2)
+        policy = RetryPolicy(max_retries=1, base_delay=0.001, breaker=breaker)
+
+        for i in range(2):
+            self.assertRaises(HTTPError, policy.call, FailingCall(http_error(502), http_error(502)))
+        self.assertTrue(breaker.is_open)
+
+        started = time.monotonic()
+        self.assertEqual(policy.call(FailingCall()), "answer")
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        self.assertFalse(breaker.is_open)
+
+    def test_should_stay_closed_for_one_failing_call(self):
+        policy = RetryPolicy(base_delay=0.001)
+        call = FailingCall(*[http_error(500) for i in range(policy.max_retries + 1)])
+
+        self.assertRaises(HTTPError, policy.call, call)
+        self.assertEqual(call.calls, policy.max_retries + 1)
+        self.assertFalse(policy.breaker.is_open)
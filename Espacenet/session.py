@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from contextlib import nullcontext
+
+import requests
+import epo_ops
+
+logger_epo = logging.getLogger('EPO')
+
+# how many keep-alive connections we keep open to OPS
+DEFAULT_POOL_SIZE = 10
+
+
+def build_session(pool_size=DEFAULT_POOL_SIZE):
+    """ A requests session with a keep-alive connection pool of pool_size """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class PooledRequest(epo_ops.models.Request):
+    """
+    Same as the epo_ops Request, but every call goes through a shared session,
+    so the TLS connections are reused between calls
+    Every call has its own env, so it can be used from many threads at once.
+    Middlewares that are not flagged thread_safe are run one call at a time.
+    When the http call fails, middlewares with a process_exception get to know it
+    """
+    def __init__(self, middlewares, session):
+        super().__init__(middlewares)
+        self.session = session
+        self._middlewares_lock = threading.Lock()
+
+    def _lock_for(self, middleware):
+        if getattr(middleware, 'thread_safe', False):
+            return nullcontext()
+        return self._middlewares_lock
+
+    def post(self, url, data=None, **kwargs):
+        env = self.default_env
+
+        for mw in self.middlewares:
+            with self._lock_for(mw):
+                url, data, kwargs = mw.process_request(
+                    env, url, data, **kwargs
+                )
+
+        # Either get response from cache environment or request from upstream
+        if env['response'] is not None:
+            response = env['response']
+        else:
+            try:
+                response = self.session.post(url, data, **kwargs)
+            except Exception as e:
+                for mw in reversed(self.middlewares):
+                    if hasattr(mw, 'process_exception'):
+                        with self._lock_for(mw):
+                            mw.process_exception(env, e)
+                raise
+
+        for mw in reversed(self.middlewares):
+            with self._lock_for(mw):
+                response = mw.process_response(env, response)
+
+        return response
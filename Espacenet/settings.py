@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+import os
+
+# where we keep what should survive between runs (access token, caches, ...)
+DATA_DIR = os.environ.get('EPO_DATA_DIR', '/var/tmp/infoscience-patents')
+
+# where the OPS responses are cached, in DATA_DIR if not set, or a shared one like redis://host:6379/0
+CACHE_URL = os.environ.get('EPO_CACHE_URL')
+
+
+def data_path(filename):
+    """ get the full path of a file in the data directory, creating the directory if needed """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return os.path.join(DATA_DIR, filename)
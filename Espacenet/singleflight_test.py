@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+
+from .singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def _run_concurrently(self, single_flight, key, func, count=5):
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(single_flight.do(key, func))
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_should_share_one_run_between_concurrent_calls(self):
+        single_flight = SingleFlight()
+        runs = []
+
+        def slow_fetch():
+            runs.append(1)
+            time.sleep(0.1)
+            return object()
+
+        results, errors = self._run_concurrently(single_flight, 'EP1000000', slow_fetch)
+
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_should_share_the_exception(self):
+        single_flight = SingleFlight()
+
+        def failing_fetch():
+            time.sleep(0.1)
+            raise ValueError("bad epodoc")
+
+        results, errors = self._run_concurrently(single_flight, 'EP1000000', failing_fetch)
+
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 5)
+
+    def test_should_run_again_once_done(self):
+        single_flight = SingleFlight()
+        runs = []
+
+        single_flight.do('EP1000000', runs.append, 1)
+        single_flight.do('EP1000000', runs.append, 2)
+        single_flight.do('EP1000001', runs.append, 3)
+
+        self.assertEqual(runs, [1, 2, 3])
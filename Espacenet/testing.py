@@ -0,0 +1,23 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from . import settings, throttle
+from .throttle import ThrottleScheduler
+
+
+class TemporaryDataDirTestCase(unittest.TestCase):
+    """
+    Tests with all the files of the clients, caches, quota, token, in a temporary
+    data directory, self.data_dir, and not in the DATA_DIR of the host
+    """
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.data_dir = tmp_dir.name
+
+        for patcher in (mock.patch.object(settings, 'DATA_DIR', self.data_dir),
+                        # the shared scheduler has its rate limiter file in the real data directory
+                        mock.patch.object(throttle, '_shared_scheduler', ThrottleScheduler())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
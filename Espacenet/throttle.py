@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+import threading
+import time
+
+from epo_ops.middlewares import Middleware
+from epo_ops.middlewares.throttle.utils import service_for_url
+
+from .rate_limiter import SharedRateLimiter
+
+logger_epo = logging.getLogger('EPO')
+
+# the most calls we let run at the same time on one service
+DEFAULT_MAX_CONCURRENCY = 10
+
+# like "busy (images=green:100, inpadoc=yellow:45, other=green:1000, retrieval=green:50, search=green:15)"
+THROTTLE_SERVICE_REGEX = r'(?P<service>\w+)=(?P<status>\w+):(?P<limit>\d+)'
+
+
+def parse_throttling_control(header):
+    """ from the X-Throttling-Control header, get a dict of service -> (status, limit per minute) """
+    services = {}
+    for matched in re.finditer(THROTTLE_SERVICE_REGEX, header or ''):
+        services[matched.group('service')] = (matched.group('status').lower(), int(matched.group('limit')))
+    return services
+
+
+class ServiceState(object):
+    """ what we know about one OPS service (search, retrieval, inpadoc, ...) """
+    def __init__(self):
+        self.status = 'green'
+        self.limit = None  # calls per minute allowed by OPS, None until told
+        self.concurrency = 1
+        self.in_flight = 0
+        self.next_start = 0.  # time.monotonic() before which we don't start a new call
+        self.blocked_until = 0.
+
+
+class ThrottleScheduler(Middleware):
+    """
+    Schedule the calls of every OPS service on its own, from the traffic light
+    and the allowance OPS gives for it in the X-Throttling-Control header :
+        - green: one more call can run at once, up to max_concurrency
+        - yellow: half of the calls can run at once
+        - red: one call at a time
+        - black: no call until the retry-after delay is over
+    Calls are spaced to stay under the allowance per minute of their service,
+    by this process alone, or by all the processes of the host when a
+    rate_limiter is given
+    """
+    thread_safe = True
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, rate_limiter=None):
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = rate_limiter
+        self.services = {}
+        self._condition = threading.Condition()
+
+    def _state(self, service):
+        if service not in self.services:
+            self.services[service] = ServiceState()
+        return self.services[service]
+
+    def acquire(self, service):
+        """ wait until a call to this service can start """
+        with self._condition:
+            state = self._state(service)
+
+            while True:
+                now = time.monotonic()
+                wait = max(state.blocked_until, state.next_start) - now
+
+                if wait <= 0 and state.in_flight < state.concurrency:
+                    break
+
+                self._condition.wait(timeout=wait if wait > 0 else None)
+
+            state.in_flight += 1
+            if state.limit and not self.rate_limiter:
+                state.next_start = now + 60. / state.limit
+
+        if self.rate_limiter:
+            try:
+                self.rate_limiter.acquire(service)
+            except Exception:
+                self.release(service)
+                raise
+
+    def release(self, service, headers=None):
+        """ a call to this service is over, learn from its headers if we have them """
+        with self._condition:
+            state = self._state(service)
+            state.in_flight -= 1
+
+            if headers is not None:
+                self.update(service, headers)
+
+            self._condition.notify_all()
+
+    def update(self, service, headers):
+        throttling = parse_throttling_control(headers.get('x-throttling-control'))
+
+        for name, (status, limit) in throttling.items():
+            state = self._state(name)
+            if limit and limit != state.limit and self.rate_limiter:
+                self.rate_limiter.set_limit(name, limit)
+            state.limit = limit or state.limit
+
+            if status == 'green':
+                # only grow the service that just answered well
+                if name == service:
+                    state.concurrency = min(state.concurrency + 1, self.max_concurrency)
+            elif status == 'yellow':
+                state.concurrency = max(state.concurrency // 2, 1)
+            elif status == 'red':
+                state.concurrency = 1
+            elif status == 'black':
+                state.concurrency = 1
+                retry_after = int(headers.get('retry-after', 0))  # in milliseconds
+                state.blocked_until = time.monotonic() + retry_after / 1000.
+                if self.rate_limiter:
+                    self.rate_limiter.block(name, retry_after / 1000.)
+
+            if status != state.status:
+                logger_epo.debug("OPS service %s is now %s, allowing %s calls at once" % (
+                    name, status, state.concurrency))
+            state.status = status
+
+    def process_request(self, env, url, data, **kwargs):
+        if not env['from-cache']:
+            service = service_for_url(url)
+            self.acquire(service)
+            env['throttle-service'] = service
+        return url, data, kwargs
+
+    def process_response(self, env, response):
+        if env.get('throttle-service'):
+            self.release(env.pop('throttle-service'), response.headers)
+        return response
+
+    def process_exception(self, env, exception):
+        if env.get('throttle-service'):
+            self.release(env.pop('throttle-service'))
+
+
+# one scheduler for the whole process, as OPS throttles by account
+_shared_scheduler = None
+_shared_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """ the scheduler of this process, sharing its allowance with the other processes of the host """
+    global _shared_scheduler
+
+    with _shared_scheduler_lock:
+        if not _shared_scheduler:
+            _shared_scheduler = ThrottleScheduler(rate_limiter=SharedRateLimiter())
+        return _shared_scheduler
@@ -0,0 +1,72 @@
+import threading
+import time
+import unittest
+
+from .throttle import ThrottleScheduler, parse_throttling_control
+
+
+def throttling_headers(retrieval='green', search='green', retrieval_limit=200, retry_after=None):
+    headers = {'x-throttling-control':
+        'busy (images=green:100, inpadoc=green:45, other=green:1000, retrieval=%s:%s, search=%s:15)' % (
+            retrieval, retrieval_limit, search)}
+    if retry_after is not None:
+        headers['retry-after'] = str(retry_after)
+    return headers
+
+
+class TestThrottleScheduler(unittest.TestCase):
+    def test_should_parse_throttling_control(self):
+        services = parse_throttling_control(throttling_headers(search='yellow')['x-throttling-control'])
+
+        self.assertEqual(services['retrieval'], ('green', 200))
+        self.assertEqual(services['search'], ('yellow', 15))
+        self.assertEqual(len(services), 5)
+
+    def test_should_grow_only_the_green_service_that_answered(self):
+        scheduler = ThrottleScheduler(max_concurrency=3)
+
+        for i in range(5):
+            scheduler.acquire('retrieval')
+            scheduler.release('retrieval', throttling_headers())
+
+        self.assertEqual(scheduler.services['retrieval'].concurrency, 3)
+        self.assertEqual(scheduler.services['search'].concurrency, 1)
+
+    def test_should_back_off_on_yellow_and_red(self):
+        scheduler = ThrottleScheduler(max_concurrency=8)
+        scheduler._state('retrieval').concurrency = 8
+
+        scheduler.update('retrieval', throttling_headers(retrieval='yellow'))
+        self.assertEqual(scheduler.services['retrieval'].concurrency, 4)
+        self.assertEqual(scheduler.services['retrieval'].status, 'yellow')
+
+        scheduler.update('retrieval', throttling_headers(retrieval='red'))
+        self.assertEqual(scheduler.services['retrieval'].concurrency, 1)
+
+    def test_should_wait_retry_after_on_black(self):
+        scheduler = ThrottleScheduler()
+        scheduler.acquire('search')
+        scheduler.release('search', throttling_headers(search='black', retry_after=200))
+
+        started = time.monotonic()
+        scheduler.acquire('search')
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        # other services are not blocked
+        started = time.monotonic()
+        scheduler.acquire('retrieval')
+        self.assertLess(time.monotonic() - started, 0.1)
+
+    def test_should_limit_calls_running_at_once(self):
+        scheduler = ThrottleScheduler()
+        scheduler.acquire('retrieval')
+        acquired = threading.Event()
+
+        def second_call():
+            scheduler.acquire('retrieval')
+            acquired.set()
+
+        threading.Thread(target=second_call, daemon=True).start()
+        self.assertFalse(acquired.wait(0.1))
+
+        scheduler.release('retrieval')
+        self.assertTrue(acquired.wait(1))
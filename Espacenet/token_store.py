@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+from .settings import data_path
+
+logger_epo = logging.getLogger('EPO')
+
+
+class StoredAccessToken(object):
+    """
+    Same interface as epo_ops.models.AccessToken,
+    but can be rebuilt from what we saved on disk
+    """
+    def __init__(self, token, expiration):
+        self.token = token
+        self.expiration = expiration  # as a timestamp
+
+    @classmethod
+    def from_response(cls, response):
+        content = response.json()
+        return cls(content['access_token'], time.time() + int(content['expires_in']))
+
+    @property
+    def expires_in(self):
+        """ seconds left before expiration """
+        return self.expiration - time.time()
+
+    @property
+    def is_expired(self):
+        return self.expires_in <= 0
+
+
+class TokenStore(object):
+    """
+    Keep the access token of a client id in a local file, so every process
+    using the same credentials can reuse it until it expires
+    """
+    def __init__(self, client_id, path=None):
+        if not path:
+            client_hash = hashlib.sha1(client_id.encode('utf-8')).hexdigest()
+            path = data_path('token-%s.json' % client_hash)
+        self.path = path
+
+    def load(self):
+        """ return the saved token, or None if there is no usable one """
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            token = StoredAccessToken(saved['token'], float(saved['expiration']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if token.is_expired:
+            return None
+
+        logger_epo.debug("Reusing the saved access token, valid for %d seconds" % token.expires_in)
+        return token
+
+    def save(self, token):
+        # write aside and rename, so a reader never see a half written token
+        tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'token': token.token, 'expiration': token.expiration}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,57 @@
+import os
+import time
+import tempfile
+import unittest
+
+from .builder import EspacenetBuilderClient
+from .testing import TemporaryDataDirTestCase
+from .token_store import TokenStore, StoredAccessToken
+
+
+class TestTokenStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = TokenStore('a-client-id', path=os.path.join(self.tmp_dir.name, 'token.json'))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_should_reload_a_saved_token(self):
+        self.store.save(StoredAccessToken('abcd', time.time() + 600))
+        token = self.store.load()
+
+        self.assertEqual(token.token, 'abcd')
+        self.assertFalse(token.is_expired)
+        self.assertGreater(token.expires_in, 590)
+
+    def test_should_not_reload_an_expired_token(self):
+        self.store.save(StoredAccessToken('abcd', time.time() - 1))
+        self.assertIsNone(self.store.load())
+
+    def test_should_not_fail_without_saved_token(self):
+        self.assertIsNone(self.store.load())
+
+
+class TestTokenStorePath(TemporaryDataDirTestCase):
+    def test_should_key_the_file_by_client_id(self):
+        self.assertNotEqual(TokenStore('a-client-id').path, TokenStore('another-client-id').path)
+        self.assertEqual(os.path.dirname(TokenStore('a-client-id').path), self.data_dir)
+
+
+class TestClientTokenReuse(TemporaryDataDirTestCase):
+    client_id = 'token-reuse-test-client'
+
+    def setUp(self):
+        super().setUp()
+        # in the temporary data directory, where the client looks for it
+        self.store = TokenStore(self.client_id)
+        self.store.save(StoredAccessToken('saved-token', time.time() + 600))
+
+    def test_should_start_with_the_saved_token(self):
+        client = EspacenetBuilderClient(key=self.client_id, secret='secret')
+        try:
+            # no network needed, the token is still fresh
+            self.assertEqual(client.access_token.token, 'saved-token')
+            self.assertIsNotNone(client._token_refresh_timer)
+        finally:
+            client.close()
@@ -59,10 +59,10 @@ def _get_best_patent_for_data(patents):
 
     # doing this here because cycling import
     from requests.exceptions import HTTPError
-    from Espacenet.builder import EspacenetBuilderClient
+    from Espacenet.builder import get_client
     import epo_ops
 
-    client = EspacenetBuilderClient(use_cache=True)
+    client = get_client()
     for patent in reversed(patents):
         try:
             a_loaded_patent = client.patent(  # Retrieve bibliography data
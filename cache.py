@@ -0,0 +1,74 @@
+import argparse
+import logging
+
+from log_utils import set_logging_configuration
+
+from Espacenet.cache import get_backend, DEFAULT_MAX_STALE, export_bundle, import_bundle
+
+
+logger = logging.getLogger('main')
+
+
+def print_stats(backend):
+    """ what the cache holds, and how often it has been useful, by endpoint """
+    by_endpoint = backend.stats_by_endpoint()
+
+    print("%-24s %10s %10s %14s %10s %10s %9s" % (
+        'endpoint', 'entries', 'expired', 'bytes', 'hits', 'misses', 'hit rate'))
+
+    totals = dict.fromkeys(('entries', 'expired', 'stored_bytes', 'hits', 'misses'), 0)
+    for endpoint, stats in sorted(by_endpoint.items()) + [('total', totals)]:
+        lookups = stats['hits'] + stats['misses']
+        print("%-24s %10s %10s %14s %10s %10s %9s" % (
+            endpoint, stats['entries'], stats['expired'], stats['stored_bytes'], stats['hits'], stats['misses'],
+            "%.1f%%" % (100. * stats['hits'] / lookups) if lookups else '-'))
+
+        if endpoint != 'total':
+            for name in totals:
+                totals[name] += stats[name]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Look after the cache of OPS responses")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser("stats",
+                          help="size and hit rate of the cache, by endpoint")
+
+    prune_parser = subparsers.add_parser("prune",
+                                         help="remove the entries that are too old to be served")
+    prune_parser.add_argument("--all-expired",
+                              help="remove also the expired entries that can still be served while refreshed",
+                              action="store_true")
+
+    export_parser = subparsers.add_parser("export",
+                                          help="write the cache in a bundle, to be imported on another host")
+    export_parser.add_argument("bundle",
+                               help="the path of the bundle to write, like cache.jsonl.gz")
+    export_parser.add_argument("--include-expired",
+                               help="export also the expired entries",
+                               action="store_true")
+
+    import_parser = subparsers.add_parser("import",
+                                          help="add the entries of a bundle to the cache, newer entries are kept")
+    import_parser.add_argument("bundle",
+                               help="the path of a bundle written by export")
+
+    args = parser.parse_args()
+    # a maintenance command, no need of a log file for it
+    set_logging_configuration(log_file=False)
+
+    backend = get_backend()
+
+    if args.command == 'stats':
+        print_stats(backend)
+    elif args.command == 'prune':
+        removed = backend.prune(expired_for=0 if args.all_expired else DEFAULT_MAX_STALE, vacuum=True)
+        logger.info("%s entries removed from the cache" % removed)
+    elif args.command == 'export':
+        exported = export_bundle(backend, args.bundle, include_expired=args.include_expired)
+        logger.info("%s entries written in %s" % (exported, args.bundle))
+    elif args.command == 'import':
+        imported = import_bundle(backend, args.bundle)
+        logger.info("%s entries imported from %s" % (imported, args.bundle))
@@ -6,14 +6,14 @@ import time
 import os
 
 import epo_ops
+from requests.exceptions import RequestException
 
 from log_utils import set_logging_configuration
 
-from Espacenet.builder import EspacenetBuilderClient, fetch_abstract_from_all_patents
+from Espacenet.builder import get_client, set_client_defaults, fetch_abstract_from_all_patents
 
 from Espacenet.marc import MarcRecordBuilder, MarcCollection, _get_best_patent_for_data
 from Espacenet.patent_models import Patent
-from Espacenet.builder import EspacenetBuilderClient
 from Espacenet.marc_xml_utils import \
     filter_out_namespace, \
     _get_controlfield_element, \
@@ -34,10 +34,18 @@ __location__ = os.path.realpath(
     os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
 
-def fetch_new_infoscience_patents(xml_str, starting_year):
+def _best_patent_input(patents):
+    """ the input of the patent of a family that has the most data """
+    best_patent_to_fetch = _get_best_patent_for_data(patents)
+    return epo_ops.models.Docdb(best_patent_to_fetch.number, best_patent_to_fetch.country, best_patent_to_fetch.kind)  # original, docdb, epodoc
+
+
+def fetch_new_infoscience_patents(xml_str, starting_year, max_quota_bytes=None, max_requests=None):
     """
     Load patents inside the xml provided
     and an updated version of it (aka added new patent to existing ones)
+    max_quota_bytes, max_requests: budget of OPS usage for this run, no new search page, bulk fetch
+        or record is started once it is reached, and the records done so far are returned
     """
     logger_infoscience.info("Loading provided xml file for fetching new patents...")
 
@@ -59,10 +67,8 @@ def fetch_new_infoscience_patents(xml_str, starting_year):
     new_patents_for_infoscience_found = 0
     patent_found_espacenet = 0
 
-    client = EspacenetBuilderClient(use_cache=True)
-    patents_for_year = client.search(
-        value = 'pa all "Ecole Polytech* Lausanne" and pd>=%s' % starting_year,
-        )
+    client = get_client()
+    client.quota.set_budget(max_quota_bytes, max_requests)
 
     infoscience_family_patent_list = []
 
@@ -71,42 +77,103 @@ def fetch_new_infoscience_patents(xml_str, starting_year):
         ):
         infoscience_family_patent_list.append(element_family_id.text)
 
-    logger_infoscience.debug("Fetched %s family ids from infoscience xml" % len(infoscience_family_patent_list))
-
-    # check if patents family are found and exists in given references
-    for family_id, patents in patents_for_year.patent_families.items():
-        if family_id not in infoscience_family_patent_list:
-            # add the patent to new
-            logger_infoscience.info("The family id %s is not in Infoscience, adding it to our xml" % family_id)
+    infoscience_family_patent_list = set(infoscience_family_patent_list)
 
-            # add it to collection
-            # but fist, get some data from a patent
-            best_patent_to_fetch = _get_best_patent_for_data(patents)
-            client = EspacenetBuilderClient(use_cache=True)
+    logger_infoscience.debug("Fetched %s family ids from infoscience xml" % len(infoscience_family_patent_list))
 
-            fulfilled_patent = client.patent(  # Retrieve bibliography data
-                input = epo_ops.models.Docdb(best_patent_to_fetch.number, best_patent_to_fetch.country, best_patent_to_fetch.kind),  # original, docdb, epodoc
-            )
-            m_record = MarcRecordBuilder().from_epo_patents(family_id=family_id,
-                                                            patents=patents,
-                                                            fulfilled_patent=fulfilled_patent,
-                                                            auto_year=True)
-            # set abstract if needed
-            if not m_record.abstract:
+    # check if patents family are found and exists in given references, page by page,
+    # and get in bulk the best patent of the new families while the next pages are downloading
+    new_patent_families = []
+    fulfilled_patents = {}
+    skipped_pages = []
+    skipped_batches = 0
+    skipped_families = 0
+
+    def skip_page(range_begin, range_end, e):
+        # offline and not in the cache, or Espacenet has a problem with it
+        logger_epo.warning("Skipping the search results %s-%s, error was %s" % (range_begin, range_end, e))
+        skipped_pages.append((range_begin, range_end))
+
+    for families_batch in client.iter_search(
+        'pa all "Ecole Polytech* Lausanne" and pd>=%s' % starting_year,
+        on_page_error=skip_page,
+        ):
+        batch_inputs = []
+        for family_id, patents in families_batch.items():
+            if family_id not in infoscience_family_patent_list:
+                new_patent_families.append((family_id, patents))
+                batch_inputs.append(_best_patent_input(patents))
+
+        if client.quota.budget_exceeded:
+            # nothing more is downloaded, the next pages included
+            logger_epo.warning("The OPS budget for this run is spent, stopping the search "
+                               "with %s new families found" % len(new_patent_families))
+            break
+
+        try:
+            for input, patent in client.patents_bulk(batch_inputs).items():
+                fulfilled_patents[input.as_api_input()] = patent
+        except RequestException as e:
+            # not fatal, the patents of this batch will be fetched one by one
+            logger_epo.warning("The bulk fetch of %s patents has failed, error was %s" % (len(batch_inputs), e))
+            skipped_batches += 1
+
+    # the families are complete only now, the records can be built
+    best_patents_inputs = {}
+    for family_id, patents in new_patent_families:
+        best_patents_inputs[family_id] = _best_patent_input(patents)
+
+    for i, (family_id, patents) in enumerate(new_patent_families):
+        if client.quota.budget_exceeded:
+            logger_epo.warning("The OPS budget for this run is spent, stopping before new family %s/%s" % (
+                i+1, len(new_patent_families)))
+            break
+
+        # add the patent to new
+        logger_infoscience.info("The family id %s is not in Infoscience, adding it to our xml" % family_id)
+
+        # add it to collection
+        # members from the next pages may have changed the best patent
+        fulfilled_patent = fulfilled_patents.get(best_patents_inputs[family_id].as_api_input())
+        try:
+            if not fulfilled_patent:
+                fulfilled_patent = client.patent(  # Retrieve bibliography data
+                    input = best_patents_inputs[family_id],
+                )
+        except RequestException as e:
+            logger_epo.warning("Skipping the family %s, Espacenet has problem with it, error was %s" % (family_id, e))
+            skipped_families += 1
+            continue
+
+        m_record = MarcRecordBuilder().from_epo_patents(family_id=family_id,
+                                                        patents=patents,
+                                                        fulfilled_patent=fulfilled_patent,
+                                                        auto_year=True)
+        # set abstract if needed
+        if not m_record.abstract:
+            try:
                 new_abstract = fetch_abstract_from_all_patents(patents)
-                if new_abstract:
-                    m_record.abstract = new_abstract
-
-            # Set to collection S2 for SISB
-            m_record.S2_collection = True  # use setter default values
-            # Set to collection TTO
-            m_record.TTO_collection = True  # use setter default values
-            m_record.collection_id = 'PATENT'
-
-            new_collection.append(m_record.marc_record)
-            new_patents_for_infoscience_found += 1
+            except RequestException as e:
+                # the record is still worth it without an abstract
+                logger_epo.warning("Can not look for an abstract for the family %s, error was %s" % (family_id, e))
+                new_abstract = None
+            if new_abstract:
+                m_record.abstract = new_abstract
+
+        # Set to collection S2 for SISB
+        m_record.S2_collection = True  # use setter default values
+        # Set to collection TTO
+        m_record.TTO_collection = True  # use setter default values
+        m_record.collection_id = 'PATENT'
+
+        new_collection.append(m_record.marc_record)
+        new_patents_for_infoscience_found += 1
 
     logger_infoscience.info("%s new record to add" % new_patents_for_infoscience_found)
+    if skipped_pages or skipped_batches or skipped_families:
+        logger_epo.warning("%s search pages, %s bulk fetches and %s families have been skipped, "
+                           "the new records may be incomplete" % (len(skipped_pages), skipped_batches, skipped_families))
+    client.log_summary()
 
     return new_collection
 
@@ -127,6 +194,20 @@ if __name__ == '__main__':
                         required=True,
                         type=int)
 
+    parser.add_argument("--max-quota-bytes",
+                        help="stop starting new records once OPS has returned this number of bytes",
+                        required=False,
+                        type=int)
+
+    parser.add_argument("--max-requests",
+                        help="stop starting new records once this number of OPS calls are done",
+                        required=False,
+                        type=int)
+
+    parser.add_argument("--offline",
+                        help="use only what is in the cache, without calling OPS",
+                        action="store_true")
+
     # create the place where we add the results
     try:
         BASE_DIR = __location__
@@ -137,6 +218,9 @@ if __name__ == '__main__':
     args = parser.parse_args()
     set_logging_configuration()
 
+    if args.offline:
+        set_client_defaults(use_network=False)
+
     # set the name of the file
     new_xml_path = os.path.join(
         BASE_DIR,
@@ -151,6 +235,8 @@ if __name__ == '__main__':
 
     is_full_export(export_as_string)
 
-    new_xml_collection = fetch_new_infoscience_patents(export_as_string, args.starting_year)
+    new_xml_collection = fetch_new_infoscience_patents(export_as_string, args.starting_year,
+                                                       max_quota_bytes=args.max_quota_bytes,
+                                                       max_requests=args.max_requests)
     logger_infoscience.info("Writing the new record(s) in %s" % new_xml_path)
     new_xml_collection.write(new_xml_path)
@@ -13,9 +13,10 @@ class InfoFilter(logging.Filter):
         return rec.levelno in (logging.DEBUG, logging.INFO)
 
 
-def set_logging_configuration(debug=False):
+def set_logging_configuration(debug=False, log_file=True):
     """
     Use --verbose and/or --debug from arguments to fix level of logging
+    Without log_file, only the console gets the logs, not a new file in ./output
     """
     # https://stackoverflow.com/questions/16061641/python-logging-split-between-stdout-and-stderr/16066513#16066513
 
@@ -40,6 +41,12 @@ def set_logging_configuration(debug=False):
         stdout_handler.setLevel(logging.INFO)
     stdout_handler.setFormatter(default_formatter)
 
+    for named_logger in (logger, logger_infoscience, logger_epo):
+        named_logger.addHandler(stdout_handler)
+
+    if not log_file:
+        return
+
     try:
         BASE_DIR = __location__
         os.mkdir('./output')
@@ -56,11 +63,6 @@ def set_logging_configuration(debug=False):
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(default_formatter)
 
-    logger.addHandler(stdout_handler)
     logger.addHandler(file_handler)
-
-    logger_infoscience.addHandler(stdout_handler)
     logger_infoscience.addHandler(file_handler)
-
-    logger_epo.addHandler(stdout_handler)
     logger_epo.addHandler(file_handler)
@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import collections
+import logging
+import xml.etree.ElementTree as ET
+
+import epo_ops
+from requests.exceptions import RequestException
+
+from log_utils import set_logging_configuration
+
+from Espacenet.marc import MarcRecordBuilder
+from Espacenet.builder import get_client, set_client_defaults
+from Espacenet.async_builder import AsyncEspacenetBuilderClient, DEFAULT_MAX_WORKERS
+from Espacenet.marc_xml_utils import filter_out_namespace
+
+
+logger = logging.getLogger('main')
+logger_infoscience = logging.getLogger('INFOSCIENCE')
+logger_epo = logging.getLogger('EPO')
+
+# countries where fetch_abstract_from_all_patents looks for an abstract
+COUNTRIES_WITH_ABSTRACT = ('EP', 'US', 'WO')
+
+
+def _records_to_prewarm(records):
+    """
+    The records the updater will work on, as an ordered dict of
+    epodoc for query -> (family id or None, epodocs of the 013, has an abstract)
+    """
+    to_prewarm = collections.OrderedDict()
+
+    for record in records:
+        marc_record = MarcRecordBuilder().from_infoscience_record(record=record)
+        # same skips as the updater
+        if not marc_record.record_id or marc_record.tagged_done or not marc_record.patents:
+            continue
+
+        epodoc_for_query = marc_record.epodoc_for_query
+        if not epodoc_for_query:
+            continue
+
+        epodocs = [patent.epodoc.split(' ')[0] for patent in marc_record.patents if patent.epodoc]
+        to_prewarm[epodoc_for_query] = (marc_record.family_id, epodocs, bool(marc_record.abstract))
+
+    return to_prewarm
+
+
+def _fetch_patents(client, epodocs):
+    """ get in bulk the biblio of these epodocs, the cache keeps each of them """
+    inputs = [epo_ops.models.Epodoc(epodoc) for epodoc in collections.OrderedDict.fromkeys(epodocs)]
+    if not inputs:
+        return {}
+
+    logger_epo.info("Fetching in bulk the biblio of %s patents..." % len(inputs))
+    try:
+        patents = client.patents_bulk(inputs)
+    except RequestException as e:
+        # not fatal, the updater will fetch them one by one
+        logger_epo.warning("The bulk fetch has failed, error was %s" % e)
+        return {}
+
+    return {input.number: patent for input, patent in patents.items()}
+
+
+def _family_patents(family):
+    """ the members of a fetched family, OPS may have none for the number """
+    if not isinstance(family, tuple):
+        return []
+    patents_families, _ = family
+    return patents_families.patents
+
+
+def _share_family(client, epodoc, other_epodocs):
+    """
+    OPS gives the same members for any publication of a family,
+    keep the family fetched for epodoc as the family of the other ones too,
+    only give the ones OPS has in its members
+    """
+    if not client.cache or not other_epodocs:
+        return
+
+    input = epo_ops.models.Epodoc(epodoc)
+    url = client._make_request_url(client.__family_path__, 'publication', input, 'biblio', [])
+    entry = client.cache.backend.get(client.cache.generate_key(url, input.as_api_input()))
+    if not entry:
+        return
+
+    for other_epodoc in other_epodocs:
+        other_input = epo_ops.models.Epodoc(other_epodoc)
+        client.cache.store(url, other_input.as_api_input(), entry.status, entry.reason, entry.headers, entry.body)
+
+
+async def _fetch_families(async_client, epodocs):
+    """ get the families of these epodocs concurrently, return epodoc -> family or the exception """
+    results = collections.OrderedDict()
+    client = async_client.client
+
+    async def fetch(epodoc):
+        if client.quota.budget_exceeded:
+            return
+        try:
+            results[epodoc] = await async_client.afamily(input=epo_ops.models.Epodoc(epodoc))
+        except RequestException as e:
+            logger_epo.warning("Can not prewarm the family of %s, error was %s" % (epodoc, e))
+            results[epodoc] = e
+
+    await asyncio.gather(*[fetch(epodoc) for epodoc in epodocs])
+    return results
+
+
+def prewarm_cache(xml_str, max_workers=DEFAULT_MAX_WORKERS, max_quota_bytes=None, max_requests=None):
+    """
+    Fill the response cache with all that the updater will ask OPS for the records of the export,
+    so the update itself can be run from the cache only
+    The biblio of the 013 epodocs is fetched in bulk, then one family by EPO family id,
+    concurrently, kept for the other records of the family when OPS has them in its members,
+    and the biblio of the members that may give a missing abstract
+    max_quota_bytes, max_requests: budget of OPS usage for this run, nothing new is asked
+        once it is reached
+    """
+    logger_infoscience.info("Loading provided xml file for a prewarm of the cache...")
+    # the same shared client as the rest of the run, so one budget and one throttle for all of it
+    set_client_defaults(pool_size=max_workers)
+    client = get_client()
+    client.quota.set_budget(max_quota_bytes, max_requests)
+
+    xml_str = filter_out_namespace(xml_str)
+    records = ET.fromstring(xml_str).findall('record')
+    to_prewarm = _records_to_prewarm(records)
+
+    logger_infoscience.info("%s records of %s need Espacenet data" % (len(to_prewarm), len(records)))
+
+    # biblio of every patent of the records, this gives the family ids we don't have too
+    patents = _fetch_patents(client, [epodoc for _, epodocs, _ in to_prewarm.values() for epodoc in epodocs])
+
+    # one family fetch by family id, it is shared with the other records of the same family
+    by_family = collections.OrderedDict()
+    for epodoc_for_query, (family_id, _, _) in to_prewarm.items():
+        if not family_id and epodoc_for_query in patents:
+            family_id = patents[epodoc_for_query].family_id
+        by_family.setdefault(family_id or epodoc_for_query, []).append(epodoc_for_query)
+
+    logger_epo.info("Fetching %s families with %s workers..." % (len(by_family), max_workers))
+
+    async_client = AsyncEspacenetBuilderClient(client, max_workers=max_workers)
+    try:
+        families = asyncio.run(_fetch_families(async_client, [epodocs[0] for epodocs in by_family.values()]))
+
+        # epodoc -> the epodoc whose family is the one of its record
+        family_of = {}
+        not_members = []
+        for epodocs in by_family.values():
+            family = families.get(epodocs[0])
+            if family is None or isinstance(family, Exception):
+                continue
+
+            # a wrong or duplicated 024 is for the updater to fix, not a reason to give a record
+            # a family OPS has not given for its number
+            members = {patent.epodoc for patent in _family_patents(family) if patent.epodoc}
+            shared = [epodoc for epodoc in epodocs[1:] if epodoc in members]
+            _share_family(client, epodocs[0], shared)
+            family_of.update((epodoc, epodocs[0]) for epodoc in [epodocs[0]] + shared)
+            not_members.extend(epodoc for epodoc in epodocs[1:] if epodoc not in members)
+
+        if not_members:
+            logger_epo.info("%s records are not in the family of their family id, "
+                            "fetching their own family..." % len(not_members))
+            own_families = asyncio.run(_fetch_families(async_client, not_members))
+            families.update(own_families)
+            family_of.update((epodoc, epodoc) for epodoc, family in own_families.items()
+                             if not isinstance(family, Exception))
+    finally:
+        async_client.close()
+
+    # the updater looks for an abstract in the members when the record has none
+    families_without_abstract = collections.OrderedDict()
+    for epodoc, (_, _, has_abstract) in to_prewarm.items():
+        if not has_abstract and epodoc in family_of:
+            families_without_abstract[family_of[epodoc]] = True
+
+    missing_abstract_epodocs = []
+    for epodoc in families_without_abstract:
+        missing_abstract_epodocs.extend(
+            patent.epodoc for patent in _family_patents(families[epodoc])
+            if patent.epodoc and patent.epodoc[0:2] in COUNTRIES_WITH_ABSTRACT and patent.epodoc not in patents)
+
+    if missing_abstract_epodocs and not client.quota.budget_exceeded:
+        _fetch_patents(client, missing_abstract_epodocs)
+
+    if client.quota.budget_exceeded:
+        logger_epo.warning("The OPS budget for this run is spent, the cache has been only partly prewarmed")
+
+    failed = [epodoc for epodoc, family in families.items() if isinstance(family, Exception)]
+    logger.info("End of the prewarm, %s families fetched, %s have failed" % (len(families) - len(failed), len(failed)))
+    client.log_summary()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-f",
+                        "--infoscience_patents_export",
+                        help="The infoscience file of patents, in a MarcXML format",
+                        required=True,
+                        type=argparse.FileType('r'))
+
+    parser.add_argument("--max-workers",
+                        help="how many OPS calls can be in flight at the same time",
+                        default=DEFAULT_MAX_WORKERS,
+                        type=int)
+
+    parser.add_argument("--max-quota-bytes",
+                        help="stop asking OPS once it has returned this number of bytes",
+                        required=False,
+                        type=int)
+
+    parser.add_argument("--max-requests",
+                        help="stop asking OPS once this number of calls are done",
+                        required=False,
+                        type=int)
+
+    args = parser.parse_args()
+    set_logging_configuration()
+
+    prewarm_cache(args.infoscience_patents_export.read(),
+                  max_workers=args.max_workers,
+                  max_quota_bytes=args.max_quota_bytes,
+                  max_requests=args.max_requests)
@@ -18,6 +18,17 @@ from Espacenet.marc_xml_utils import \
 from updater import update_infoscience_export
 
 from Espacenet.builder_test import *
+from Espacenet.token_store_test import *
+from Espacenet.async_builder_test import *
+from Espacenet.throttle_test import *
+from Espacenet.rate_limiter_test import *
+from Espacenet.quota_test import *
+from Espacenet.retry_test import *
+from Espacenet.singleflight_test import *
+from Espacenet.negative_cache_test import *
+from Espacenet.cache_test import *
+from Espacenet.redis_backend_test import *
+from Espacenet.memory_cache_test import *
 from Espacenet.marc_tester import *
 
 __location__ = os.path.realpath(
@@ -1,17 +1,19 @@
 import argparse
+import collections
+import copy
 import logging
 import xml.etree.ElementTree as ET
 import time
 import os
 
 import epo_ops
-from requests.exceptions import HTTPError
+from requests.exceptions import RequestException
 
 from log_utils import set_logging_configuration
 
 from Espacenet.marc import MarcRecordBuilder, MarcCollection
 from Espacenet.patent_models import Patent
-from Espacenet.builder import EspacenetBuilderClient, fetch_abstract_from_all_patents
+from Espacenet.builder import get_client, set_client_defaults, fetch_abstract_from_all_patents
 from Espacenet.marc_xml_utils import \
     filter_out_namespace, \
     _get_controlfield_element, \
@@ -39,16 +41,158 @@ def is_full_export(xml_file):
     assert len(records) > 1000, """It looks like you did not provide the full export,
                                     we have only %s records, and we need more than 1000""" % len(records)
 
-def update_infoscience_export(xml_str, range_start=None, range_end=None):
+def _fetch_patents_for_missing_family(client, records):
+    """
+    Get in bulk the patents of the records without family id,
+    return a dict of epodoc -> patent
+    """
+    inputs = {}
+
+    for record in records:
+        marc_record = MarcRecordBuilder().from_infoscience_record(record=record)
+        if marc_record.record_id and not marc_record.tagged_done and not marc_record.family_id:
+            epodoc_for_query = marc_record.epodoc_for_query
+            if epodoc_for_query:
+                inputs[epodoc_for_query] = epo_ops.models.Epodoc(epodoc_for_query)
+
+    if not inputs:
+        return {}
+
+    logger_infoscience.info("Fetching in bulk the patents of %s records without family id..." % len(inputs))
+
+    try:
+        patents = client.patents_bulk(inputs.values())
+    except RequestException as e:
+        # not fatal, records will be fetched one by one
+        logger_epo.warning("The bulk fetch has failed, error was %s" % e)
+        return {}
+
+    return {epodoc: patents[input] for epodoc, input in inputs.items() if input in patents}
+
+
+def _update_record(client, record, patents_for_missing_family, counters, position):
+    """
+    Update one record of the export with Espacenet data
+    Return the updated marc record, or None if it does not need an update
+    Raise a RequestException when Espacenet has a problem with it, or can't be reached
+    """
+    has_been_patent_updated = False
+    has_been_family_updated = False
+    has_been_notes_for_alternatives_title_changed = False
+    has_been_abstract_added = False
+    marc_record = MarcRecordBuilder().from_infoscience_record(record=record)
+
+    family_id_text = ""
+    if marc_record.family_id:
+        family_id_text = "family id = %s" % marc_record.family_id
+    else:
+        family_id_text = "No family id"
+
+    logger_infoscience.info("--------")
+    logger_infoscience.info("Parsing record %s, %s (%s)" % (
+            marc_record.record_id,
+            family_id_text,
+            position,
+            )
+        )
+
+    # is it good to go ?
+    if not marc_record.record_id:
+        logger_infoscience.info(
+            "Skipping record %s, the record has no id" % marc_record.record_id
+            )
+        return
+
+    if marc_record.tagged_done:
+        logger_infoscience.info(
+            "Skipping record %s, the tag 974__b is set" % marc_record.record_id
+            )
+        return
+
+    if len(marc_record.patents) == 0:
+        logger_infoscience.info(
+            "Skipping record %s, no patents have been found in it" % marc_record.record_id
+            )
+        return
+
+    # get the best epodoc to do queries or abort
+    epodoc_for_query = marc_record.epodoc_for_query
+    if not epodoc_for_query:
+        logger_infoscience.info(
+            "Skipping record %s, patent(s) are not in a known format" % marc_record.record_id
+            )
+        return
+
+    # check family
+    if not marc_record.family_id:
+        # try to get the family_id before going to update
+        logger_infoscience.info("Missing family id for this record, parsing one...")
+
+        patent = patents_for_missing_family.get(epodoc_for_query)
+        if not patent:
+            patent = client.patent(
+                input = epo_ops.models.Epodoc(epodoc_for_query),
+            )
+
+        marc_record.family_id = patent.family_id
+        logger_infoscience.info("Updating Family id to %s" % marc_record.family_id)
+        has_been_family_updated = True
+        counters['family_updated'] += 1
+
+    patents_families, fulfilled_patent = client.family(
+        input = epo_ops.models.Epodoc(epodoc_for_query)
+    )
+
+    # comparing the length should do the trick, the epodoc don't change everytimes
+    if len(patents_families.patents) != len(marc_record.patents):
+        # we have a different number of patents, update the marc record
+        logger_infoscience.info("The record need a patent update, doing the update with through patent %s..." % epodoc_for_query)
+
+        marc_record.update_patents_from_espacenet(patents_families.patents)
+
+        assert(len(marc_record.patents) != 0)
+        has_been_patent_updated = True
+        counters['patent_updated'] += 1
+
+        logger_infoscience.info("Updated patents for this record to : %s" % marc_record.patents)
+    else:
+        logger_infoscience.info("This record does not need an update of his patents")
+
+    # set alternative titles
+    has_been_notes_for_alternatives_title_changed = MarcRecordBuilder().set_titles(marc_record, fulfilled_patent)
+
+    if has_been_notes_for_alternatives_title_changed:
+        logger_infoscience.info("This record need an update of his alternative titles")
+        counters['alternative_titles_updated'] += 1
+
+    # set abstract if needed
+    if not marc_record.abstract:
+        new_abstract = fetch_abstract_from_all_patents(patents_families.patents)
+        if new_abstract:
+            marc_record.abstract = new_abstract
+            logger_infoscience.info("This record need an update of his abstract")
+            has_been_abstract_added = True
+            counters['abstract_added'] += 1
+
+    if has_been_patent_updated or has_been_family_updated or has_been_notes_for_alternatives_title_changed or has_been_abstract_added:
+        marc_record.sort_record_content()
+        return marc_record
+
+
+def update_infoscience_export(xml_str, range_start=None, range_end=None, max_quota_bytes=None, max_requests=None):
     """
     Load patents inside the xml provided
     and an updated version of it (aka added new patent to existing ones)
     args:
         xml_file: the marcXML of infoscience patents
         range_start, range_end: set one if you want to update only a range of patents (mainly used in tests)
+        max_quota_bytes, max_requests: budget of OPS usage for this run, no new record is started
+            once it is reached, and the records done so far are returned
+    Records that failed on a transient Espacenet error are tried again at the end of the run
     """
     logger_infoscience.info("Loading provided xml file for an update...")
-    client = EspacenetBuilderClient(use_cache=True)
+    client = get_client()
+    client.quota.set_budget(max_quota_bytes, max_requests)
 
     xml_str = filter_out_namespace(xml_str)
     provided_collection = ET.fromstring(xml_str)
@@ -59,132 +203,55 @@ def update_infoscience_export(xml_str, range_start=None, range_end=None):
     logger_infoscience.info("Starting the update with the provided xml...")
 
     # some counters for logs
-    patent_updated = 0
-    family_updated = 0
-    alternative_titles_updated = 0
-    abstract_added = 0
+    counters = collections.Counter()
 
     # limit as asked
     records = records[range_start:range_end]
 
-    for i, record in enumerate(records):
-        has_been_patent_updated = False
-        has_been_family_updated = False
-        has_been_notes_for_alternatives_title_changed = False
-        has_been_abstract_added = False
-        marc_record = MarcRecordBuilder().from_infoscience_record(record=record)
+    patents_for_missing_family = _fetch_patents_for_missing_family(client, records)
 
-        family_id_text = ""
-        if marc_record.family_id:
-            family_id_text = "family id = %s" % marc_record.family_id
-        else:
-            family_id_text = "No family id"
-
-        logger_infoscience.info("--------")
-        logger_infoscience.info("Parsing record %s, %s (%s/%s)" % (
-                marc_record.record_id,
-                family_id_text,
-                i+1,
-                len(records),
-                )
-            )
+    retry_queue = []
+
+    for is_retry, records_to_do in ((False, records), (True, retry_queue)):
+        if is_retry and retry_queue:
+            logger_infoscience.info("--------")
+            logger_infoscience.info("Trying again the %s records that have failed..." % len(retry_queue))
 
-        # is it good to go ?
-        if not marc_record.record_id:
-            logger_infoscience.info(
-                "Skipping record %s, the record has no id" % marc_record.record_id
-                )
-            continue
-
-        if marc_record.tagged_done:
-            logger_infoscience.info(
-                "Skipping record %s, the tag 974__b is set" % marc_record.record_id
-                )
-            continue
-
-        if len(marc_record.patents) == 0:
-            logger_infoscience.info(
-                "Skipping record %s, no patents have been found in it" % marc_record.record_id
-                )
-            continue
-
-        # get the best epodoc to do queries or abort
-        epodoc_for_query = marc_record.epodoc_for_query
-        if not epodoc_for_query:
-            logger_infoscience.info(
-                "Skipping record %s, patent(s) are not in a known format" % marc_record.record_id
-                )
-            continue
-
-        # check family
-        if not marc_record.family_id:
-            # try to get the family_id before going to update
-            logger_infoscience.info("Missing family id for this record, parsing one...")
+        for i, record in enumerate(records_to_do):
+            if client.quota.budget_exceeded:
+                logger_epo.warning("The OPS budget for this run is spent, stopping before record %s/%s" % (
+                    i+1, len(records_to_do)))
+                break
 
+            # work on copies, so a failed record can be tried again from the start
+            record_counters = collections.Counter()
             try:
-                patent = client.patent(
-                    input = epo_ops.models.Epodoc(epodoc_for_query),
-                )
-            except HTTPError as e:
-                logger_epo.warning(
-                    "Skipping this record, it crash Espacenet: %s, error was %s" % (epodoc_for_query, e)
-                    )
+                marc_record = _update_record(client,
+                                             copy.deepcopy(record),
+                                             patents_for_missing_family,
+                                             record_counters,
+                                             "%s/%s" % (i+1, len(records_to_do)))
+            except RequestException as e:
+                # an HTTP error, or a connection error or a timeout after all their retries
+                if not is_retry and client.retry_policy.is_retryable(e):
+                    logger_epo.warning("Espacenet has failed on this record, it will be tried again at the end, error was %s" % e)
+                    retry_queue.append(record)
+                else:
+                    logger_epo.warning("Skipping this record, Espacenet has problem with it, error was %s" % e)
                 continue
 
-            marc_record.family_id = patent.family_id
-            logger_infoscience.info("Updating Family id to %s" % marc_record.family_id)
-            has_been_family_updated = True
-            family_updated += 1
+            counters.update(record_counters)
 
-        try:
-            patents_families, fulfilled_patent = client.family(
-                input = epo_ops.models.Epodoc(epodoc_for_query)
-            )
-        except HTTPError as e:
-            logger_epo.warning("Skipping this record, Espacenet has problem with it: %s, error was %s" % (epodoc_for_query, e))
-            continue
-
-        # comparing the length should do the trick, the epodoc don't change everytimes
-        if len(patents_families.patents) != len(marc_record.patents):
-            # we have a different number of patents, update the marc record
-            logger_infoscience.info("The record need a patent update, doing the update with through patent %s..." % epodoc_for_query)
-
-            marc_record.update_patents_from_espacenet(patents_families.patents)
-
-            assert(len(marc_record.patents) != 0)
-            has_been_patent_updated = True
-            patent_updated += 1
-
-            logger_infoscience.info("Updated patents for this record to : %s" % marc_record.patents)
-        else:
-            logger_infoscience.info("This record does not need an update of his patents")
-
-        # set alternative titles
-        has_been_notes_for_alternatives_title_changed = MarcRecordBuilder().set_titles(marc_record, fulfilled_patent)
-
-        if has_been_notes_for_alternatives_title_changed:
-            logger_infoscience.info("This record need an update of his alternative titles")
-            alternative_titles_updated += 1
-
-        # set abstract if needed
-        if not marc_record.abstract:
-            new_abstract = fetch_abstract_from_all_patents(patents_families.patents)
-            if new_abstract:
-                marc_record.abstract = new_abstract
-                logger_infoscience.info("This record need an update of his abstract")
-                has_been_abstract_added = True
-                abstract_added += 1
-
-        if has_been_patent_updated or has_been_family_updated or has_been_notes_for_alternatives_title_changed or has_been_abstract_added:
-            marc_record.sort_record_content()
-            # save record to the update collection
-            update_collection.append(marc_record.marc_record)
+            if marc_record:
+                # save record to the update collection
+                update_collection.append(marc_record.marc_record)
 
     logger.info("End of parsing, %s records will be updated from this batch" % len(update_collection.findall("record")))
-    logger.info("%s have a new family_id" % family_updated)
-    logger.info("%s have an update for at least a patent" % patent_updated)
-    logger.info("%s have new alternative titles" % alternative_titles_updated)
-    logger.info("%s have a new abstract" % abstract_added)
+    logger.info("%s have a new family_id" % counters['family_updated'])
+    logger.info("%s have an update for at least a patent" % counters['patent_updated'])
+    logger.info("%s have new alternative titles" % counters['alternative_titles_updated'])
+    logger.info("%s have a new abstract" % counters['abstract_added'])
+    client.log_summary()
 
     return update_collection
 
@@ -210,6 +277,20 @@ if __name__ == '__main__':
                         required=False,
                         type=int)
 
+    parser.add_argument("--max-quota-bytes",
+                        help="stop starting new records once OPS has returned this number of bytes",
+                        required=False,
+                        type=int)
+
+    parser.add_argument("--max-requests",
+                        help="stop starting new records once this number of OPS calls are done",
+                        required=False,
+                        type=int)
+
+    parser.add_argument("--offline",
+                        help="use only what is in the cache, without calling OPS",
+                        action="store_true")
+
     # create the place where we add the results
     try:
         BASE_DIR = __location__
@@ -220,6 +301,9 @@ if __name__ == '__main__':
     args = parser.parse_args()
     set_logging_configuration()
 
+    if args.offline:
+        set_client_defaults(use_network=False)
+
     # set the name of the file
     update_xml_path = os.path.join(
         BASE_DIR,
@@ -232,8 +316,12 @@ if __name__ == '__main__':
     is_full_export(export_as_string)
 
     if (args.start or args.start == 0) and args.end:
-        updated_xml_collection = update_infoscience_export(export_as_string, args.start, args.end)
+        updated_xml_collection = update_infoscience_export(export_as_string, args.start, args.end,
+                                                           max_quota_bytes=args.max_quota_bytes,
+                                                           max_requests=args.max_requests)
     else:
-        updated_xml_collection = update_infoscience_export(export_as_string)
+        updated_xml_collection = update_infoscience_export(export_as_string,
+                                                           max_quota_bytes=args.max_quota_bytes,
+                                                           max_requests=args.max_requests)
     logger_infoscience.info("Writing the updated record(s) in %s" % update_xml_path)
     updated_xml_collection.write(update_xml_path)